@@ -0,0 +1,42 @@
+# Micro-benchmark of analyze_html (analyze_clan_html for the squadron pages) and of encoding its result, per parser backend, on the recorded fixtures.
+#
+#   python benchmarks/bench_parse.py --rounds 200
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from models import encode  # noqa: E402
+from parsing import PARSERS, analyze_clan_html, analyze_html  # noqa: E402
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def measure(fn, rounds: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+
+def main(args):
+    fixtures = {path.stem: path.read_text(encoding="utf-8") for path in sorted(FIXTURES.glob("*.html"))}
+    parsers = args.parser or list(PARSERS)
+    print(f"{'fixture':<16} {'parser':<8} {'parse ms':>9} {'encode ms':>10}")
+    for name, page in fixtures.items():
+        analyze = analyze_clan_html if name.startswith("clan") else analyze_html
+        for parser in parsers:
+            result = analyze(page, parser)
+            parse = measure(lambda: analyze(page, parser), args.rounds)
+            encoding = measure(lambda: encode(result), args.rounds)
+            print(f"{name:<16} {parser:<8} {parse * 1000:>9.3f} {encoding * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time analyze_html per parser backend")
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--parser", action="append", choices=list(PARSERS), help="parser to time, default all")
+    main(parser.parse_args())
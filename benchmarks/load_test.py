@@ -0,0 +1,101 @@
+# Load test for GET /player: for every concurrency level, a fixed number of requests is sent from a pool of
+# workers. A share of --hit-ratio asks for a small hot set of nicks that is warmed before measuring, the rest asks
+# for nicks never seen before, so those go upstream. Run it against an API that scrapes mock_upstream.py.
+#
+#   python benchmarks/load_test.py --url http://127.0.0.1:8000 --concurrency 1,8,32 --hit-ratio 0.9
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+
+import aiohttp
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(p / 100 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def fetch(session: aiohttp.ClientSession, url: str, nick: str) -> tuple[float, int]:
+    # the API answers lookup failures (timeouts, upstream errors) with HTTP 200, only the code in the body tells;
+    # 0 stands for a request that got no response at all
+    start = time.perf_counter()
+    try:
+        async with session.get(f"{url}/player", params={"nick": nick}) as response:
+            body = await response.read()
+            code = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return time.perf_counter() - start, 0
+    latency = time.perf_counter() - start
+    try:
+        code = json.loads(body)["code"]
+    except (ValueError, KeyError, TypeError):
+        pass
+    return latency, code
+
+
+async def run_level(session: aiohttp.ClientSession, url: str, concurrency: int, requests: int, hit_ratio: float,
+                    hot: list[str]) -> dict:
+    run_id = uuid.uuid4().hex[:8]
+    counter = itertools.count()
+    latencies, codes = [], {}
+
+    def next_nick() -> str:
+        if random.random() < hit_ratio:
+            return random.choice(hot)
+        return f"cold_{run_id}_{next(counter)}"
+
+    async def worker(count: int):
+        for _ in range(count):
+            latency, code = await fetch(session, url, next_nick())
+            latencies.append(latency)
+            codes[code] = codes.get(code, 0) + 1
+
+    per_worker, extra = divmod(requests, concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(per_worker + (i < extra)) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "errors": {code: count for code, count in sorted(codes.items()) if code != 200},
+    }
+
+
+async def main(args):
+    hot = [f"hot_{i}" for i in range(args.hot_set)]
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        warm = await asyncio.gather(*(fetch(session, args.url, nick) for nick in hot))
+        print(f"warmed {len(hot)} hot nicks in {sum(latency for latency, _ in warm):.1f}s "
+              f"({sum(code == 200 for _, code in warm)} ok)")
+        print(f"{'conc':>5} {'reqs':>6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}  by code")
+        for concurrency in args.concurrency:
+            result = await run_level(session, args.url, concurrency, args.requests, args.hit_ratio, hot)
+            print(f"{result['concurrency']:>5} {result['requests']:>6} {result['throughput']:>9.1f} "
+                  f"{result['p50'] * 1000:>9.1f} {result['p95'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} "
+                  f"{sum(result['errors'].values()):>7}  "
+                  f"{' '.join(f'{code}:{count}' for code, count in result['errors'].items()) or '-'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure /player throughput and latency")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base URL of the API")
+    parser.add_argument("--concurrency", type=lambda value: [int(c) for c in value.split(",")], default=[1, 8, 32],
+                        help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=500, help="requests per concurrency level")
+    parser.add_argument("--hit-ratio", type=float, default=0.9, help="share of requests for already cached nicks")
+    parser.add_argument("--hot-set", type=int, default=50, help="number of cached nicks")
+    parser.add_argument("--timeout", type=float, default=60, help="per request timeout in seconds")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,79 @@
+# Local stand-in for the warthunder.com profile page, serving the recorded fixtures next to this file.
+# Start it, then point the API at it with UPSTREAM_URL=http://127.0.0.1:8081 (and PROXY_HOST left empty).
+#
+#   missing*  -> "player not found" page
+#   slow*     -> answers after --slow-delay seconds, past the scraper's page timeout by default
+#   clan*     -> player in a squadron
+#   noclan*   -> fresh account without a squadron, most statistics N/A
+#   anything else -> normal player
+#
+# Squadron pages list 20 clan* members, squadrons named missing* are not found.
+import argparse
+import asyncio
+import html
+import random
+from pathlib import Path
+
+from aiohttp import web
+
+FIXTURES = Path(__file__).parent / "fixtures"
+PLACEHOLDER = "TestPlayer"
+CLAN_PLACEHOLDER = "TestSquadron"
+
+
+def load_fixtures() -> dict[str, str]:
+    return {path.stem: path.read_text(encoding="utf-8") for path in FIXTURES.glob("*.html")}
+
+
+def pick_fixture(nick: str) -> str:
+    folded = nick.casefold()
+    if folded.startswith("missing"):
+        return "not_found"
+    if folded.startswith("noclan"):
+        return "player_no_clan"
+    if folded.startswith("clan"):
+        return "player_clan"
+    return "player"
+
+
+def create_app(latency: float = 0, jitter: float = 0, slow_delay: float = 35) -> web.Application:
+    fixtures = load_fixtures()
+    app = web.Application()
+    app["requests"] = 0
+
+    async def userinfo(request: web.Request) -> web.Response:
+        app["requests"] += 1
+        nick = request.query.get("nick", "")
+        delay = slow_delay if nick.casefold().startswith("slow") else latency + random.uniform(0, jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        page = fixtures[pick_fixture(nick)].replace(PLACEHOLDER, html.escape(nick))
+        return web.Response(text=page, content_type="text/html")
+
+    async def claninfo(request: web.Request) -> web.Response:
+        app["requests"] += 1
+        name = request.match_info["name"]
+        if latency or jitter:
+            await asyncio.sleep(latency + random.uniform(0, jitter))
+        fixture = "clan_not_found" if name.casefold().startswith("missing") else "clan"
+        page = fixtures[fixture].replace(CLAN_PLACEHOLDER, html.escape(name))
+        return web.Response(text=page, content_type="text/html")
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response({"requests": app["requests"]})
+
+    app.router.add_get("/en/community/userinfo/", userinfo)
+    app.router.add_get("/en/community/claninfo/{name}", claninfo)
+    app.router.add_get("/_stats", stats)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded War Thunder profile pages")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.2, help="base response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="extra random delay of up to this many seconds")
+    parser.add_argument("--slow-delay", type=float, default=35, help="delay for slow* nicks in seconds")
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency, args.jitter, args.slow_delay), host=args.host, port=args.port)
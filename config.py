@@ -0,0 +1,75 @@
+import os
+
+# 从环境变量获取代理配置，设置默认值
+PROXY_HOST = os.getenv('PROXY_HOST', '')
+PROXY_PORT = int(os.getenv('PROXY_PORT', 0))
+# 独立抓取服务（scraper_service.py）监听的 Unix socket；API 设置后不再自行启动浏览器，而是把抓取请求发给该服务
+SCRAPER_SOCKET = os.getenv('SCRAPER_SOCKET', '')
+SCRAPER_SERVICE_TIMEOUT = float(os.getenv('SCRAPER_SERVICE_TIMEOUT', 120))
+# 上游站点地址，可指向 benchmarks/mock_upstream.py 进行离线测试
+UPSTREAM_URL = os.getenv('UPSTREAM_URL', 'https://warthunder.com')
+# 浏览器标签页池大小，以及等待空闲标签页的超时时间（秒）
+SCRAPER_TABS = int(os.getenv('SCRAPER_TABS', 4))
+SCRAPER_TAB_TIMEOUT = float(os.getenv('SCRAPER_TAB_TIMEOUT', 30))
+# 浏览器实例数（每个实例各有 SCRAPER_TABS 个标签页），按负载分配请求
+SCRAPER_BROWSERS = int(os.getenv('SCRAPER_BROWSERS', 1))
+# 浏览器健康检查间隔（秒），以及实例在加载多少页面或内存（MB）超过多少后重启，0 表示不限制
+BROWSER_CHECK_INTERVAL = float(os.getenv('BROWSER_CHECK_INTERVAL', 30))
+BROWSER_MAX_PAGES = int(os.getenv('BROWSER_MAX_PAGES', 2000))
+BROWSER_MAX_RSS_MB = int(os.getenv('BROWSER_MAX_RSS_MB', 1500))
+# 发往上游的全局请求速率（次/秒）与突发容量；各优先级（交互、批量、后台）预计排队超过该秒数时直接返回 503 与 Retry-After，
+# 等待空闲标签页也不超过该秒数；HTTP 快速路径未命中后回退到浏览器时再占用一个令牌
+UPSTREAM_RATE = float(os.getenv('UPSTREAM_RATE', 5))
+UPSTREAM_BURST = int(os.getenv('UPSTREAM_BURST', 10))
+UPSTREAM_WAIT_INTERACTIVE = float(os.getenv('UPSTREAM_WAIT_INTERACTIVE', 5))
+UPSTREAM_WAIT_BATCH = float(os.getenv('UPSTREAM_WAIT_BATCH', 30))
+UPSTREAM_WAIT_BACKGROUND = float(os.getenv('UPSTREAM_WAIT_BACKGROUND', 10))
+# 启动时预热：预先启动浏览器与标签页、解析进程，并用一个确定存在的玩家页面预先通过 Cloudflare 验证；
+# 预先缓存的热门玩家（逗号分隔）；预热最长时间（秒），超时后也视为就绪
+WARMUP = os.getenv('WARMUP', '0') == '1'
+WARMUP_NICK = os.getenv('WARMUP_NICK', '')
+WARMUP_NICKS = [n.strip() for n in os.getenv('WARMUP_NICKS', '').split(',') if n.strip()]
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 120))
+# HTML 解析后端：lxml（默认，需安装 lxml 与 cssselect）或 bs4
+HTML_PARSER = os.getenv('HTML_PARSER', '') or None
+# 解析进程数（0 表示在事件循环内直接解析）以及最大排队页面数
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', 2))
+PARSE_QUEUE = int(os.getenv('PARSE_QUEUE', 32))
+# 页面加载时拦截的资源类型（CDP ResourceType，逗号分隔）与 URL 通配符，白名单中的 URL 永不拦截
+BLOCK_RESOURCES = [t for t in os.getenv('BLOCK_RESOURCES', 'Image,Media,Font').split(',') if t]
+BLOCK_URLS = [u for u in os.getenv('BLOCK_URLS', '*google-analytics.com*,*googletagmanager.com*,*doubleclick.net*,'
+                                                 '*connect.facebook.net*,*mc.yandex.ru*').split(',') if u]
+ALLOW_URLS = [u for u in os.getenv('ALLOW_URLS', '*challenges.cloudflare.com*').split(',') if u]
+# 页面 DOM 解析完成且出现该选择器时即抓取内容
+READY_SELECTOR = os.getenv('READY_SELECTOR', 'div.user-profile, #GCM-Container')
+# 使用浏览器获取的 Cloudflare cookies 通过 aiohttp 直接请求，遇到验证页时回退到浏览器；cookies 的刷新周期（秒）
+HTTP_FAST_PATH = os.getenv('HTTP_FAST_PATH', '1') == '1'
+COOKIE_TTL = float(os.getenv('COOKIE_TTL', 900))
+# 按该比例抽样记录单次抓取各阶段耗时的日志（0 表示关闭）
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+# 本机所有 worker 共享的 SQLite 缓存文件；软过期后仍返回旧数据并在后台刷新，硬过期后删除（秒）
+CACHE_PATH = os.getenv('CACHE_PATH', 'cache.sqlite3')
+CACHE_SOFT_TTL = int(os.getenv('CACHE_SOFT_TTL', 300))
+CACHE_HARD_TTL = int(os.getenv('CACHE_HARD_TTL', 3600))
+# 不存在的玩家（404）的缓存时间（秒）
+NEGATIVE_TTL = int(os.getenv('NEGATIVE_TTL', 600))
+# 批量查询单次最多的玩家数，以及未命中缓存时同时抓取的数量
+BATCH_MAX_NICKS = int(os.getenv('BATCH_MAX_NICKS', 100))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+# 战队成员列表的缓存时间（秒），以及战队查询时未命中缓存的成员同时抓取的数量
+CLAN_TTL = int(os.getenv('CLAN_TTL', 3600))
+CLAN_CONCURRENCY = int(os.getenv('CLAN_CONCURRENCY', 4))
+# 热门玩家在缓存软过期前 REFRESH_LEAD 秒内主动刷新；每分钟主动刷新的上游请求预算（所有 worker 共享）；访问热度阈值与半衰期（秒）
+# 注意：访问热度由每个 worker 各自统计，多 worker 时每个 worker 只看到自己处理的访问，阈值相当于按 worker 数放大
+REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', 10))
+REFRESH_LEAD = float(os.getenv('REFRESH_LEAD', 60))
+REFRESH_BUDGET = int(os.getenv('REFRESH_BUDGET', 30))
+REFRESH_MIN_SCORE = float(os.getenv('REFRESH_MIN_SCORE', 2))
+REFRESH_HALF_LIFE = float(os.getenv('REFRESH_HALF_LIFE', 3600))
+# 缓存最多保留的条目数，超出时淘汰最久未刷新的冷门条目
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 50000))
+# 玩家历史数据文件；保留天数（0 表示永久保留）
+HISTORY_PATH = os.getenv('HISTORY_PATH', 'history.sqlite3')
+HISTORY_RETENTION_DAYS = float(os.getenv('HISTORY_RETENTION_DAYS', 365))
+# 每个 worker 将自己的计数器写入共享缓存文件的间隔（秒），/metrics 返回所有 worker 的合计
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 15))
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+try:
+    from aiohttp_socks import ProxyConnector
+except ImportError:
+    ProxyConnector = None
+
+# markers of a Cloudflare interstitial, any of them means the request has to go through the browser
+CHALLENGE_MARKERS = ("challenge-platform", "cf-chl-", "<title>Just a moment...</title>")
+# only pages that carry a player profile (or a squadron roster) are trusted, anything else but a "not found" page is
+# confirmed by the browser
+PROFILE_MARKER = "user-profile__data-nick"
+SQUADRON_MARKER = "squadrons-members__table"
+# the site's page layout around the content, a page that has it but not the marker is a genuine "not found" page
+# (an unknown nick or squadron) and is answered from here too
+LAYOUT_MARKER = 'id="GCM-Container"'
+
+
+class HttpFetcher:
+
+    def __init__(self, user_agent: str, proxy_host: str = "", proxy_port: int = 0, connections: int = 16,
+                 cookie_ttl: float = 900, timeout: float = 10):
+        self.user_agent = user_agent
+        self.proxy_host = proxy_host
+        self.proxy_port = proxy_port
+        self.connections = connections
+        self.cookie_ttl = cookie_ttl
+        self.timeout = timeout
+        self.cookie_header = ""
+        self.cookies_at = 0.0
+        self.hits = 0
+        self.not_found = 0
+        self.fallbacks = 0
+        self.challenges = 0
+        self._session = None
+        self.enabled = True
+        if proxy_host and ProxyConnector is None:
+            logging.warning("aiohttp-socks is not installed, the HTTP fast path is disabled")
+            self.enabled = False
+
+    @property
+    def needs_cookies(self) -> bool:
+        return self.enabled and time.monotonic() - self.cookies_at > self.cookie_ttl
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "hits": self.hits, "not_found": self.not_found, "fallbacks": self.fallbacks,
+                "challenges": self.challenges, "cookie_age": round(time.monotonic() - self.cookies_at)
+                if self.cookies_at else None}
+
+    def update_cookies(self, cookies: list):
+        self.cookie_header = "; ".join(f"{c.name}={c.value}" for c in cookies
+                                       if c.domain.lstrip(".").endswith("warthunder.com"))
+        self.cookies_at = time.monotonic()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            if self.proxy_host:
+                connector = ProxyConnector.from_url(f"socks5://{self.proxy_host}:{self.proxy_port}",
+                                                    limit=self.connections, rdns=True)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.connections)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                # cookies come from the browser only, responses must not overwrite them
+                cookie_jar=aiohttp.DummyCookieJar(),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": self.user_agent,
+                         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+                         "Accept-Language": "en-US,en;q=0.9"})
+        return self._session
+
+    async def fetch(self, url: str, marker: str = PROFILE_MARKER) -> str | None:
+        if not self.enabled or self.needs_cookies:
+            return None
+        try:
+            async with self._get_session().get(url, headers={"Cookie": self.cookie_header}) as response:
+                content = await response.text()
+                challenged = response.headers.get("cf-mitigated") == "challenge"
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"HTTP fast path failed for {url}: {e!r}")
+            self.fallbacks += 1
+            return None
+        if challenged or status in (403, 429, 503) or any(m in content for m in CHALLENGE_MARKERS):
+            # clearance is gone, stay on the browser until it has solved the challenge again
+            self.challenges += 1
+            self.cookies_at = 0.0
+            return None
+        if status in (200, 404) and marker not in content and LAYOUT_MARKER in content:
+            self.not_found += 1
+            return content
+        if status != 200 or marker not in content:
+            self.fallbacks += 1
+            return None
+        self.hits += 1
+        return content
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
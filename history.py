@@ -0,0 +1,202 @@
+import asyncio
+import math
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from models import _VEHICLES, MODES, PATHS, PlayerStats, stat_index
+
+# one column per statistic, named by its path in the JSON object, plus the player level
+FIELDS = ("player_level",
+          *(".".join(("statistics", *(part for part in path if part))) for path in PATHS[:_VEHICLES]),
+          *(f"vehicles_and_rewards.{country}.{name}" for country, _, name in PATHS[_VEHICLES:]))
+COLUMN = {name: i for i, name in enumerate(FIELDS)}
+
+_DURATION = re.compile(r"(?:(\d+)d)?\s*(?:(\d+)h)?\s*(?:(\d+)m)?")
+
+
+def to_number(value) -> float:
+    # counters stay as they are, "57%" becomes 57 and play times like "3d 4h 12m" become minutes
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value.endswith("%"):
+        return float(value[:-1])
+    match = _DURATION.fullmatch(value.strip())
+    if match and any(match.groups()):
+        days, hours, minutes = (int(group or 0) for group in match.groups())
+        return float((days * 24 + hours) * 60 + minutes)
+    return math.nan
+
+
+def to_vector(data: PlayerStats) -> np.ndarray:
+    return np.array([data.player_level, *(to_number(value) for value in data.values)], dtype=np.float64)
+
+
+# per mode: the battle counters of the three vehicle classes, and the kills and deaths of the general statistics
+BATTLE_COLUMNS = {mode: [1 + stat_index(mode, section, f"{name}_battles")
+                         for section, name in (("aviation", "air"), ("ground", "ground"), ("fleet", "naval"))]
+                  for mode in MODES}
+KILL_COLUMNS = {mode: [1 + stat_index(mode, None, f"{kind}_targets_destroyed") for kind in ("air", "ground", "naval")]
+                for mode in MODES}
+DEATH_COLUMN = {mode: 1 + stat_index(mode, None, "deaths") for mode in MODES}
+
+
+# Every successful lookup appended as a timestamped vector of all numeric statistics. A row holds either the whole
+# vector (a keyframe, every keyframe_interval rows) or only the columns that changed since the previous row, so
+# players polled often but playing rarely cost a few bytes per poll. Vectors are float64 arrays stored as blobs.
+class HistoryStore:
+
+    def __init__(self, path: str = "history.sqlite3", keyframe_interval: int = 32):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS history (
+            nick TEXT NOT NULL,
+            ts REAL NOT NULL,
+            keyframe INTEGER NOT NULL,
+            columns BLOB NOT NULL,
+            vals BLOB NOT NULL,
+            PRIMARY KEY (nick, ts)
+        )""")
+
+    async def _call(self, fn, *args):
+        def run():
+            with self._lock:
+                return fn(*args)
+
+        return await asyncio.to_thread(run)
+
+    def _rows(self, nick: str, since: float = 0, until: float = math.inf) -> list:
+        # from the last keyframe at or before since, so the first state in the window can be rebuilt
+        return self._conn.execute(
+            "SELECT ts, keyframe, columns, vals FROM history WHERE nick = ? AND ts <= ? AND ts >= COALESCE("
+            "(SELECT MAX(ts) FROM history WHERE nick = ? AND keyframe = 1 AND ts <= ?), 0) ORDER BY ts",
+            (nick, until, nick, max(since, 0))).fetchall()
+
+    @staticmethod
+    def _replay(rows: list) -> tuple[np.ndarray, np.ndarray]:
+        times = np.empty(len(rows))
+        states = np.full((len(rows), len(FIELDS)), np.nan)
+        state = np.full(len(FIELDS), np.nan)
+        for i, (ts, keyframe, columns, vals) in enumerate(rows):
+            vals = np.frombuffer(vals, dtype=np.float64)
+            if keyframe:
+                state = vals.copy()
+            else:
+                state[np.frombuffer(columns, dtype=np.uint16)] = vals
+            times[i] = ts
+            states[i] = state
+        return times, states
+
+    def _record(self, nick: str, vector: np.ndarray, ts: float) -> bool:
+        rows = self._rows(nick, since=math.inf)
+        if rows and len(rows) < self.keyframe_interval:
+            _, states = self._replay(rows)
+            # NaN != NaN, compare with equal_nan so unparsable values don't count as a change every time
+            changed = ~np.isclose(states[-1], vector, rtol=0, atol=0, equal_nan=True)
+            if not changed.any():
+                return False
+            columns = np.flatnonzero(changed).astype(np.uint16)
+            self._conn.execute("INSERT OR REPLACE INTO history VALUES (?, ?, 0, ?, ?)",
+                               (nick, ts, columns.tobytes(), vector[columns].tobytes()))
+        else:
+            if rows and np.array_equal(self._replay(rows)[1][-1], vector, equal_nan=True):
+                return False
+            self._conn.execute("INSERT OR REPLACE INTO history VALUES (?, ?, 1, ?, ?)",
+                               (nick, ts, b"", vector.tobytes()))
+        return True
+
+    async def record(self, nick: str, data: PlayerStats, ts: float = None) -> bool:
+        return await self._call(self._record, nick, to_vector(data), ts or time.time())
+
+    async def load(self, nick: str, since: float = 0, until: float = math.inf) -> tuple[np.ndarray, np.ndarray]:
+        times, states = await self._call(lambda: self._replay(self._rows(nick, since, until)))
+        # the keyframe the replay started from may lie before the window, its state still applies at since
+        first = max(np.searchsorted(times, since, side="right") - 1, 0)
+        return times[first:], states[first:]
+
+    def _prune(self, before: float) -> int:
+        # keep, per player, the last keyframe before the cutoff, the rows after it build on it
+        return self._conn.execute(
+            "DELETE FROM history WHERE ts < (SELECT MAX(h.ts) FROM history h "
+            "WHERE h.nick = history.nick AND h.keyframe = 1 AND h.ts <= ?)", (before,)).rowcount
+
+    async def prune(self, before: float) -> int:
+        return await self._call(self._prune, before)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _number(value: float):
+    if math.isnan(value):
+        return None
+    return int(value) if value.is_integer() else float(value)
+
+
+def changed_fields(states: np.ndarray) -> np.ndarray:
+    if len(states) < 2:
+        return np.zeros(len(FIELDS), dtype=bool)
+    return ~np.all(np.isclose(states, states[0], rtol=0, atol=0, equal_nan=True), axis=0)
+
+
+def battles_per_day(times: np.ndarray, states: np.ndarray) -> list[dict]:
+    # last known total per calendar day (UTC), differenced against the day before
+    if len(times) < 2:
+        return []
+    days = (times // 86400).astype(np.int64)
+    last = np.flatnonzero(np.append(days[1:] != days[:-1], True))
+    out = []
+    totals = {mode: np.nansum(states[last][:, BATTLE_COLUMNS[mode]], axis=1) for mode in MODES}
+    for i in range(1, len(last)):
+        entry = {"day": time.strftime("%Y-%m-%d", time.gmtime(int(days[last[i]]) * 86400))}
+        for mode in MODES:
+            entry[mode] = _number(totals[mode][i] - totals[mode][i - 1])
+        out.append(entry)
+    return out
+
+
+def kd_trend(times: np.ndarray, states: np.ndarray) -> dict:
+    # lifetime K/D at every point and the K/D of just the battles played within the window
+    trend = {}
+    for mode in MODES:
+        kills = np.nansum(states[:, KILL_COLUMNS[mode]], axis=1)
+        deaths = states[:, DEATH_COLUMN[mode]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(deaths > 0, kills / deaths, np.nan)
+        gained_kills, gained_deaths = kills[-1] - kills[0], deaths[-1] - deaths[0]
+        trend[mode] = {
+            "lifetime": [_number(round(value, 3)) for value in ratio],
+            "window": _number(round(gained_kills / gained_deaths, 3)) if gained_deaths > 0 else None,
+        }
+    return trend
+
+
+def history_result(nick: str, times: np.ndarray, states: np.ndarray, fields: list[str] = None) -> dict:
+    columns = [COLUMN[name] for name in fields] if fields else np.flatnonzero(changed_fields(states))
+    return {
+        "nickname": nick,
+        "times": [_number(round(ts, 3)) for ts in times],
+        "fields": {FIELDS[c]: [_number(value) for value in states[:, c]] for c in columns},
+        "battles_per_day": battles_per_day(times, states),
+        "kd_trend": kd_trend(times, states),
+    }
+
+
+def diff_result(nick: str, times: np.ndarray, states: np.ndarray) -> dict:
+    first, last = states[0], states[-1]
+    changed = np.flatnonzero(~np.isclose(first, last, rtol=0, atol=0, equal_nan=True))
+    return {
+        "nickname": nick,
+        "from": _number(round(times[0], 3)),
+        "to": _number(round(times[-1], 3)),
+        "changes": {FIELDS[c]: {"from": _number(first[c]), "to": _number(last[c]),
+                                "delta": _number(last[c] - first[c])} for c in changed},
+    }
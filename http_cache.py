@@ -0,0 +1,90 @@
+import gzip
+import hashlib
+import time
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from storage import CacheEntry
+
+# smaller bodies are sent as they are, compressing them would barely save the size of the headers
+MIN_COMPRESS_SIZE = 512
+# in order of preference when the client accepts several
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def compress(body: bytes) -> dict[str, bytes]:
+    # done once per cached entry rather than per response, so the slowest and smallest settings pay off
+    if len(body) < MIN_COMPRESS_SIZE:
+        return {}
+    encoded = {"gzip": gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        encoded["br"] = brotli.compress(body, mode=brotli.MODE_TEXT, quality=11)
+    return encoded
+
+
+def prepare(body: bytes) -> tuple[str, dict[str, bytes]]:
+    return make_etag(body), compress(body)
+
+
+def negotiate(accept_encoding: str, available: dict) -> str | None:
+    # the preferred precomputed coding the Accept-Encoding header allows, an explicit q=0 rules a coding out
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # weak comparison, as If-None-Match asks for; every content coding of the same body matches
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.strip('"')
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        if tag and tag.split("-", 1)[0] == opaque:
+            return True
+    return False
+
+
+def respond(request: Request, entry: CacheEntry) -> Response:
+    if entry.etag is None:
+        # errors are not cached here, clients must not keep them either
+        return Response(content=entry.value, media_type="application/json", headers={"Cache-Control": "no-store"})
+
+    now = time.time()
+    encoding = negotiate(request.headers.get("accept-encoding", ""), entry.encoded)
+    headers = {
+        # the whole soft TTL, downstream caches subtract the Age themselves; once Age passes it the entry is
+        # revalidated on every request
+        "Cache-Control": f"public, max-age={max(int(entry.stale_at - entry.stored_at), 0)}",
+        "Age": str(max(int(now - entry.stored_at), 0)),
+        "Vary": "Accept-Encoding",
+        # strong validators are per representation, so each content coding gets its own tag
+        "ETag": entry.etag if encoding is None else f'{entry.etag[:-1]}-{encoding}"',
+    }
+    if etag_matches(request.headers.get("if-none-match", ""), entry.etag):
+        return Response(status_code=304, headers=headers)
+    if encoding is None:
+        return Response(content=entry.value, media_type="application/json", headers=headers)
+    headers["Content-Encoding"] = encoding
+    return Response(content=entry.encoded[encoding], media_type="application/json", headers=headers)
@@ -1,33 +1,56 @@
-import os
+import asyncio
 import logging
-from contextlib import asynccontextmanager
+import os
+import time
+import uuid
+from contextlib import aclosing, asynccontextmanager
+from datetime import datetime, timezone
 from typing import AsyncIterator
+from urllib.parse import unquote
 
-from fastapi import FastAPI, Request, Response
-from fastapi.responses import RedirectResponse
+from fastapi import Body, FastAPI, Request, Response
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
 from fastapi_cache.decorator import cache
 from fastapi_utils.tasks import repeat_every
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
 
-from scraping import Scraping
+import http_cache
+import metrics
+import models
+import parsing
+from config import (BATCH_CONCURRENCY, BATCH_MAX_NICKS, BROWSER_CHECK_INTERVAL, CACHE_HARD_TTL, CACHE_MAX_ENTRIES,
+                    CACHE_PATH, CACHE_SOFT_TTL, CLAN_CONCURRENCY, CLAN_TTL, HISTORY_PATH, HISTORY_RETENTION_DAYS,
+                    METRICS_INTERVAL, NEGATIVE_TTL, REFRESH_BUDGET,
+                    REFRESH_HALF_LIFE, REFRESH_INTERVAL, REFRESH_LEAD, REFRESH_MIN_SCORE, SCRAPER_SERVICE_TIMEOUT,
+                    SCRAPER_SOCKET, SCRAPER_TAB_TIMEOUT, WARMUP, WARMUP_NICK, WARMUP_NICKS, WARMUP_TIMEOUT)
+from history import COLUMN as history_fields, HistoryStore, diff_result, history_result
+from scheduler import RefreshScheduler
+from scraper_service import ScraperClient, create_scraper
+from scraping import SingleFlight
+from storage import CacheEntry, SQLiteBackend
+from upstream import Ticket
 
 logging.basicConfig(level="INFO", format='%(process)d | %(levelname)s | %(asctime)s | %(name)s | %(message)s')
 
-# 从环境变量获取代理配置，设置默认值
-PROXY_HOST = os.getenv('PROXY_HOST', '')
-PROXY_PORT = int(os.getenv('PROXY_PORT', 0))
-
 
 @asynccontextmanager
 async def lifespan(_: FastAPI) -> AsyncIterator[None]:
-    await clear_cache()
-    FastAPICache.init(InMemoryBackend())
+    FastAPICache.init(cache_backend)
+    await refresh_hot_players()
+    await prune_cache()
+    await supervise_browsers()
+    await publish_metrics()
+    # in the background so /ready can answer while it runs
+    warm_up_task = asyncio.create_task(warm_up())
     yield
-    await FastAPICache.clear("warthunder")
+    warm_up_task.cancel()
+    await publish_worker_metrics()
+    await scraper.close()
+    cache_backend.close()
+    history.close()
 
 
 limiter = Limiter(key_func=get_remote_address)
@@ -35,12 +58,278 @@ app = FastAPI(lifespan=lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
-scraper = Scraping(proxy_host=PROXY_HOST, proxy_port=PROXY_PORT)
+if SCRAPER_SOCKET:
+    # browsers live in the scraper service shared by all workers
+    scraper = ScraperClient(SCRAPER_SOCKET, timeout=SCRAPER_SERVICE_TIMEOUT)
+else:
+    scraper = create_scraper()
+cache_backend = SQLiteBackend(CACHE_PATH, stale_ttl=max(CACHE_HARD_TTL - CACHE_SOFT_TTL, 0))
+history = HistoryStore(HISTORY_PATH)
+background_tasks = set()
+# this process' row in the shared metrics table, unique even when a later process reuses the pid
+metrics_worker = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+# lookups of a nick that is already being refreshed share the compression and the cache writes as well as the scrape
+refreshes = SingleFlight()
+# what /ready reports, ready once the warm-up at startup is over
+readiness = {"ready": False, "stage": "starting", "browsers": None, "cached": 0, "seconds": None, "error": None}
+
+
+INTERNAL_ERROR = {"code": 500, "message": "Internal Server Error", "tip": "Please try again later.", "data": None}
+SUCCESS = {"code": 200, "message": "Success", "tip": "Fk cf!"}
+NO_HISTORY = {"code": 404, "message": "No history recorded for this player",
+              "tip": "History starts with the first successful lookup of the player.", "data": None}
+
+
+class ServerBusy(Exception):
+
+    def __init__(self, body: bytes, retry_after: int):
+        super().__init__(f"Server busy, retry after {retry_after}s")
+        self.body = body
+        self.retry_after = retry_after
+
+
+def player_cache_key(name: str) -> str:
+    # parsed results belong to one parser version, after an upgrade they are parsed again from the snapshots
+    return f"{FastAPICache.get_prefix()}:warthunder:v{parsing.PARSER_VERSION}:{name}"
+
+
+def section_cache_key(name: str, section: str, snapshot: CacheEntry) -> str:
+    # per version of the page, a refreshed snapshot never reuses the sections of the one it replaced
+    return (f"{FastAPICache.get_prefix()}:warthunder:v{parsing.PARSER_VERSION}:section:{section}:"
+            f"{snapshot.stored_at:.6f}:{name}")
+
+
+def fields_cache_key(name: str, fields: list[str], source: CacheEntry) -> str:
+    # a selection of one version of the player's result or page snapshot
+    return (f"{FastAPICache.get_prefix()}:warthunder:v{parsing.PARSER_VERSION}:fields:{','.join(fields)}:"
+            f"{source.stored_at:.6f}:{name}")
+
+
+def snapshot_cache_key(name: str) -> str:
+    return f"{FastAPICache.get_prefix()}:warthunder:html:{name}"
+
+
+def missing_cache_key(name: str) -> str:
+    return f"{FastAPICache.get_prefix()}:warthunder:missing:{name}"
+
+
+def clan_cache_key(name: str) -> str:
+    return f"{FastAPICache.get_prefix()}:warthunder:clan:{name}"
+
+
+async def cache_put(key: str, body: bytes, expire: int, stale_ttl: int = None) -> CacheEntry:
+    # the ETag and the compressed bodies are worked out once here, every hit sends them as they are
+    etag, encoded = await asyncio.to_thread(http_cache.prepare, body)
+    return await cache_backend.set(key, body, expire=expire, stale_ttl=stale_ttl, etag=etag, encoded=encoded)
+
+
+def uncached(body: bytes) -> CacheEntry:
+    now = time.time()
+    return CacheEntry(body, now, now, now)
+
+
+async def refresh_player_stat(name: str, proactive: bool = False, priority: str = "interactive") -> CacheEntry:
+    # the ticket goes down to the scrape, so an interactive lookup joining a batch or background refresh raises it
+    return await refreshes.do(name, _refresh_player_stat, name, proactive, ticket=Ticket(priority))
+
+
+async def _refresh_player_stat(name: str, proactive: bool, ticket: Ticket) -> CacheEntry:
+    result = await scraper.get_player_stat(name, ticket) or INTERNAL_ERROR
+    html = result.get("html")
+    if html is not None:
+        # the page is cached on its own, clients only get the parsed result
+        result = {key: value for key, value in result.items() if key != "html"}
+    # encoded once, the same bytes are cached and sent to the client
+    body = models.encode(result)
+    entry = uncached(body)
+    # errors and timeouts are not cached so that the next request retries them
+    if result["code"] == 200:
+        entry = await cache_put(player_cache_key(name), body, expire=CACHE_SOFT_TTL)
+        if html is not None:
+            snapshot = await asyncio.to_thread(parsing.compress_html, html)
+            await cache_backend.set(snapshot_cache_key(name), snapshot, expire=CACHE_SOFT_TTL)
+        # tied to the snapshot when there is one, it outlives parser upgrades
+        await cache_backend.set_canonical(result["data"].nickname or name,
+                                          snapshot_cache_key(name) if html is not None else player_cache_key(name))
+        await history.record(result["data"].nickname or name, result["data"])
+        scheduler.record_refresh(name, time.time() + CACHE_SOFT_TTL, proactive=proactive)
+    elif result["code"] == 404:
+        # negative entries are never served stale, they simply expire
+        entry = await cache_put(missing_cache_key(name), body, expire=NEGATIVE_TTL, stale_ttl=0)
+    elif result["code"] == 503:
+        # shed before reaching upstream, the caller answers 503 with Retry-After
+        raise ServerBusy(body, result.get("retry_after") or 1)
+    return entry
+
+
+async def refresh_in_background(name: str, proactive: bool = False):
+    try:
+        await refresh_player_stat(name, proactive=proactive, priority="background")
+    except ServerBusy:
+        # upstream is saturated, the stale entry keeps being served until a later refresh gets through
+        pass
+
+
+async def refresh_hot_player(name: str):
+    # another worker may be refreshing the same player, the lease keeps it to one upstream request
+    if await cache_backend.acquire_refresh(player_cache_key(name), SCRAPER_TAB_TIMEOUT + 30):
+        await refresh_in_background(name, proactive=True)
+
+
+async def take_refresh_token() -> bool:
+    # one budget for all workers, kept in the shared cache file next to the refresh leases
+    return await cache_backend.take_token("refresh", REFRESH_BUDGET / 60, REFRESH_BUDGET)
+
+
+scheduler = RefreshScheduler(refresh_hot_player, scraper.idle_capacity, lead=REFRESH_LEAD,
+                             budget_per_minute=REFRESH_BUDGET, min_score=REFRESH_MIN_SCORE,
+                             half_life=REFRESH_HALF_LIFE, take_token=take_refresh_token)
+
 
+async def revalidate(name: str, key: str):
+    # stale-while-revalidate: answer from the stale entry and let one worker refresh it in the background
+    if await cache_backend.acquire_refresh(key, SCRAPER_TAB_TIMEOUT + 30):
+        task = asyncio.create_task(refresh_in_background(name))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
 
-@cache(namespace="warthunder", expire=300)
-async def cache_get_player_stat(name: str):
-    return await scraper.get_player_stat(name)
+
+async def cache_get_player_stat(name: str, priority: str = "interactive") -> CacheEntry:
+    key = player_cache_key(name)
+    entry = await cache_backend.get_entry(key)
+    if entry is None:
+        # nicks are case sensitive upstream, a known player asked for in another case resolves to its real spelling
+        canonical = await cache_backend.get_canonical(name)
+        if canonical is not None and canonical != name:
+            return await cache_get_player_stat(canonical, priority)
+        missing = await cache_backend.get_entry(missing_cache_key(name))
+        if missing is not None:
+            metrics.CACHE_LOOKUPS.inc("negative")
+            return missing
+    scheduler.record_access(name, entry.stale_at if entry else 0)
+    if entry is None:
+        snapshot = await cache_backend.get_entry(snapshot_cache_key(name))
+        if snapshot is None:
+            metrics.CACHE_LOOKUPS.inc("miss")
+            return await refresh_player_stat(name, priority=priority)
+        # the page is kept until its hard expiry, a stale one is parsed again and served while it is refreshed
+        metrics.CACHE_LOOKUPS.inc("reparse")
+        entry = await reparse_snapshot(name, snapshot, priority)
+    else:
+        metrics.CACHE_LOOKUPS.inc("stale" if entry.stale else "hit")
+    if entry.stale:
+        await revalidate(name, key)
+    return entry
+
+
+async def cache_put_derived(key: str, body: bytes, source: CacheEntry) -> CacheEntry:
+    # as fresh and as old as the entry it was derived from, and gone when that entry is
+    now = time.time()
+    etag, encoded = await asyncio.to_thread(http_cache.prepare, body)
+    return await cache_backend.set(key, body, expire=max(int(source.stale_at - now), 0),
+                                   stale_ttl=max(int(source.expires_at - max(source.stale_at, now)), 1),
+                                   etag=etag, encoded=encoded, stored_at=source.stored_at)
+
+
+async def reparse_snapshot(name: str, snapshot: CacheEntry, priority: str = "interactive") -> CacheEntry:
+    # the parsed result is gone or was parsed by an older version, the page it came from is still cached
+    html = await asyncio.to_thread(parsing.decompress_html, snapshot.value)
+    result = await scraper.analyze_snapshot(html, models.SECTION_NAMES)
+    if result["code"] == 503:
+        # the parsers are saturated, scraping the page again would only add to the load
+        raise ServerBusy(models.encode(result), result.get("retry_after") or 1)
+    if result["code"] != 200:
+        return await refresh_player_stat(name, priority=priority)
+    return await cache_put_derived(player_cache_key(name), models.encode(result), snapshot)
+
+
+async def snapshot_fields(name: str, snapshot: CacheEntry, fields: list[str], key: str) -> CacheEntry:
+    # only the sections the fields need are parsed, each one is memoized for as long as this snapshot is kept
+    parts, missing = [], []
+    for section in models.sections_for(fields):
+        memo = await cache_backend.get(section_cache_key(name, section, snapshot))
+        if memo is None:
+            missing.append(section)
+        else:
+            parts.append(models.decode(memo))
+    if missing:
+        html = await asyncio.to_thread(parsing.decompress_html, snapshot.value)
+        result = await scraper.analyze_snapshot(html, tuple(missing))
+        if result["code"] == 503:
+            raise ServerBusy(models.encode(result), result.get("retry_after") or 1)
+        if result["code"] != 200:
+            return uncached(models.encode(result))
+        data = result["data"].to_dict()
+        expire = max(int(snapshot.expires_at - time.time()), 1)
+        for section in missing:
+            part = models.extract_section(data, section)
+            await cache_backend.set(section_cache_key(name, section, snapshot), models.encode(part),
+                                    expire=expire, stale_ttl=0)
+            parts.append(part)
+    body = models.encode({**SUCCESS, "data": models.select_fields(models.merge_sections(parts), fields)})
+    return await cache_put_derived(key, body, snapshot)
+
+
+async def cache_get_player_fields(name: str, fields: list[str], priority: str = "interactive") -> CacheEntry:
+    # sorted and without repeats, so every spelling of the same selection shares one memoized body
+    fields = sorted(set(fields))
+    snapshot = None
+    if await cache_backend.get_entry(player_cache_key(name)) is None:
+        snapshot = await cache_backend.get_entry(snapshot_cache_key(name))
+    if snapshot is not None:
+        scheduler.record_access(name, snapshot.stale_at)
+        metrics.CACHE_LOOKUPS.inc("sections")
+        if snapshot.stale:
+            await revalidate(name, snapshot_cache_key(name))
+        source = snapshot
+    else:
+        source = await cache_get_player_stat(name, priority)
+        if source.etag is None:
+            # an error that was not cached
+            return source
+    key = fields_cache_key(name, fields, source)
+    memo = await cache_backend.get_entry(key)
+    if memo is not None:
+        return memo
+    if snapshot is not None:
+        return await snapshot_fields(name, snapshot, fields, key)
+    result = models.decode(source.value)
+    if result["code"] != 200:
+        return source
+    result["data"] = models.select_fields(result["data"], fields)
+    return await cache_put_derived(key, models.encode(result), source)
+
+
+async def refresh_clan(name: str, priority: str = "interactive") -> bytes:
+    result = await scraper.get_clan(name, priority) or INTERNAL_ERROR
+    body = models.encode(result)
+    if result["code"] == 200:
+        await cache_backend.set(clan_cache_key(name), body, expire=CLAN_TTL)
+    elif result["code"] == 404:
+        await cache_backend.set(clan_cache_key(name), body, expire=NEGATIVE_TTL, stale_ttl=0)
+    elif result["code"] == 503:
+        raise ServerBusy(body, result.get("retry_after") or 1)
+    return body
+
+
+async def refresh_clan_in_background(name: str):
+    try:
+        await refresh_clan(name, priority="background")
+    except ServerBusy:
+        pass
+
+
+async def cache_get_clan(name: str) -> bytes:
+    # the member list changes slowly, a stale roster is served while one worker fetches the page again
+    key = clan_cache_key(name)
+    entry = await cache_backend.get_entry(key)
+    if entry is None:
+        return await refresh_clan(name)
+    if entry.stale and await cache_backend.acquire_refresh(key, SCRAPER_TAB_TIMEOUT + 30):
+        task = asyncio.create_task(refresh_clan_in_background(name))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return entry.value
 
 
 @app.get("/")
@@ -51,7 +340,7 @@ async def root():
 
 @cache(namespace="warthunder")
 @app.get("/player")
-async def player_stat(request: Request, response: Response, nick: str = None):
+async def player_stat(request: Request, response: Response, nick: str = None, fields: str = None):
     if not nick:
         response.status_code = 400
         return {
@@ -69,8 +358,285 @@ async def player_stat(request: Request, response: Response, nick: str = None):
         }
         
 
-    result = await cache_get_player_stat(nick)
-    return result
+    fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else []
+    unknown = [field for field in fields if field not in models.FIELD_SECTIONS]
+    if unknown:
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": f"Unknown fields: {', '.join(unknown)}. Known fields: {', '.join(models.FIELD_SECTIONS)}",
+            "data": None
+        }
+
+    try:
+        entry = await cache_get_player_fields(nick, fields) if fields else await cache_get_player_stat(nick)
+    except ServerBusy as e:
+        return Response(content=e.body, status_code=503, media_type="application/json",
+                        headers={"Retry-After": str(e.retry_after), "Cache-Control": "no-store"})
+    return http_cache.respond(request, entry)
+
+
+async def lookup_players(nicks: list[str], concurrency: int):
+    # cached players are answered right away, only the misses wait for one of the scrape slots
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def lookup(nick: str):
+        try:
+            if await cache_backend.get_entry(player_cache_key(nick)) is not None:
+                body = (await cache_get_player_stat(nick, "batch")).value
+            else:
+                async with semaphore:
+                    body = (await cache_get_player_stat(nick, "batch")).value
+        except ServerBusy as e:
+            body = e.body
+        except Exception as e:
+            logging.error(e)
+            body = models.encode(INTERNAL_ERROR)
+        return nick, body
+
+    tasks = [asyncio.create_task(lookup(nick)) for nick in nicks]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # the client went away, don't keep scraping for it
+        for task in tasks:
+            task.cancel()
+
+
+async def stream_player_stats(nicks: list[str]):
+    async with aclosing(lookup_players(nicks, BATCH_CONCURRENCY)) as results:
+        async for nick, body in results:
+            # splice the nick into the cached object instead of decoding and re-encoding it
+            yield b'{"nick":' + models.encode(nick) + b"," + body[1:] + b"\n"
+
+
+@app.post("/players")
+async def players_stat(response: Response, nicks: list[str] = Body(...)):
+    # keep the first occurrence of every nick, in request order
+    nicks = list(dict.fromkeys(nick.strip() for nick in nicks if isinstance(nick, str) and nick.strip()))
+    if not nicks:
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": "Body must be a non-empty list of nicks",
+            "data": None
+        }
+    if len(nicks) > BATCH_MAX_NICKS:
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": f"At most {BATCH_MAX_NICKS} nicks can be requested at once",
+            "data": None
+        }
+
+    return StreamingResponse(stream_player_stats(nicks), media_type="application/x-ndjson")
+
+
+async def stream_clan(squadron: dict):
+    # the roster first, then every member as soon as their statistics are in, then the squadron totals
+    members = {member["nickname"]: member for member in squadron["members"]}
+    yield models.encode({"type": "squadron", "name": squadron["name"], "size": len(members)}) + b"\n"
+    summaries = []
+    async with aclosing(lookup_players(list(members), CLAN_CONCURRENCY)) as results:
+        async for nick, body in results:
+            result = models.decode(body)
+            line = {"type": "member", **members[nick], "code": result["code"]}
+            if result["code"] == 200:
+                line["summary"] = models.player_summary(result["data"])
+                summaries.append(line["summary"])
+            else:
+                line["message"] = result["message"]
+            yield models.encode(line) + b"\n"
+    yield models.encode({"type": "totals", "members": len(members), "found": len(summaries),
+                         "failed": len(members) - len(summaries), **models.squadron_totals(summaries)}) + b"\n"
+
+
+@app.get("/clan")
+async def clan_stat(response: Response, name: str = None):
+    if not name or not name.strip():
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": "Parameter \"name\" is required",
+            "data": None
+        }
+    name = name.strip()
+    if "/claninfo/" in name:
+        # the clan_url of a player profile works as well
+        name = unquote(name.rsplit("/claninfo/", 1)[1].strip("/"))
+
+    try:
+        body = await cache_get_clan(name)
+    except ServerBusy as e:
+        return Response(content=e.body, status_code=503, media_type="application/json",
+                        headers={"Retry-After": str(e.retry_after)})
+    result = models.decode(body)
+    if result["code"] != 200:
+        return Response(content=body, media_type="application/json")
+    return StreamingResponse(stream_clan(result["data"]), media_type="application/x-ndjson")
+
+
+def parse_time(value: str) -> float:
+    # unix seconds or an ISO 8601 date/time, UTC unless it says otherwise
+    try:
+        return float(value)
+    except ValueError:
+        moment = datetime.fromisoformat(value)
+        return (moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)).timestamp()
+
+
+async def load_history(nick: str, since: str = None, until: str = None):
+    # answered from the history store alone, a player without history is not scraped for it
+    name = await cache_backend.get_canonical(nick) or nick
+    times, states = await history.load(name, parse_time(since) if since else 0,
+                                       parse_time(until) if until else float("inf"))
+    return name, times, states
+
+
+@app.get("/player/history")
+async def player_history(response: Response, nick: str = None, since: str = None, until: str = None,
+                         fields: str = None):
+    if not nick or not nick.strip():
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": "Parameter \"nick\" is required",
+            "data": None
+        }
+    fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else []
+    unknown = [field for field in fields if field not in history_fields]
+    if unknown:
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": f"Unknown fields: {', '.join(unknown)}",
+            "data": None
+        }
+    try:
+        name, times, states = await load_history(nick, since, until)
+    except ValueError:
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": "Parameters \"since\" and \"until\" must be unix timestamps or ISO 8601 dates",
+            "data": None
+        }
+
+    if len(times) == 0:
+        return Response(content=models.encode(NO_HISTORY), media_type="application/json")
+    data = history_result(name, times, states, fields)
+    return Response(content=models.encode({**SUCCESS, "data": data}), media_type="application/json")
+
+
+@app.get("/player/diff")
+async def player_diff(response: Response, nick: str = None, since: str = None, until: str = None):
+    if not nick or not nick.strip():
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": "Parameter \"nick\" is required",
+            "data": None
+        }
+    try:
+        name, times, states = await load_history(nick, since, until)
+    except ValueError:
+        response.status_code = 400
+        return {
+            "code": 400,
+            "message": "Parameters \"since\" and \"until\" must be unix timestamps or ISO 8601 dates",
+            "data": None
+        }
+
+    if len(times) == 0:
+        return Response(content=models.encode(NO_HISTORY), media_type="application/json")
+    data = diff_result(name, times, states)
+    return Response(content=models.encode({**SUCCESS, "data": data}), media_type="application/json")
+
+
+async def _warm_up():
+    if WARMUP:
+        readiness["stage"] = "browsers"
+        readiness["browsers"] = await scraper.warm_up(WARMUP_NICK)
+    if WARMUP_NICKS:
+        readiness["stage"] = "cache"
+        async with aclosing(lookup_players(WARMUP_NICKS, BATCH_CONCURRENCY)) as results:
+            async for _, body in results:
+                if models.decode(body)["code"] == 200:
+                    readiness["cached"] += 1
+
+
+async def warm_up():
+    # browsers, challenge and hot players are ready before traffic arrives instead of on the first requests; a
+    # warm-up that runs out of time leaves the instance no worse off than a cold start, so it is ready anyway, but one
+    # that fails (browsers that do not start) keeps /ready at 503 and is tried again
+    start = time.perf_counter()
+    while True:
+        readiness["cached"] = 0
+        try:
+            await asyncio.wait_for(_warm_up(), WARMUP_TIMEOUT)
+            readiness["error"] = None
+        except TimeoutError:
+            logging.warning(f"Warm-up did not finish within {WARMUP_TIMEOUT}s")
+            readiness["error"] = "timeout"
+        except Exception as e:
+            logging.error(f"Warm-up failed, retrying in {BROWSER_CHECK_INTERVAL}s: {e!r}")
+            readiness.update(stage="failed", error=repr(e))
+            await asyncio.sleep(BROWSER_CHECK_INTERVAL)
+            continue
+        break
+    readiness.update(ready=True, stage="done", seconds=round(time.perf_counter() - start, 3))
+    logging.info(f"Ready after {readiness['seconds']}s: browsers {readiness['browsers']}, "
+                 f"{readiness['cached']}/{len(WARMUP_NICKS)} hot players cached")
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    if not readiness["ready"]:
+        response.status_code = 503
+    return readiness
+
+
+@app.get("/stats")
+async def stats():
+    return {**await scraper.fetch_stats(), "refresh": scheduler.stats()}
+
+
+# one stats() snapshot taken per /metrics render and shared by the gauges below; it leaves out the browser RSS,
+# which walks every Chrome process, and only the RSS gauge asks for that
+scraper_snapshot = {}
+
+metrics.REGISTRY.gauge("scraper_tabs_open", "Browser tabs in the pool", lambda: scraper_snapshot["tabs"]["size"])
+metrics.REGISTRY.gauge("scraper_tabs_in_use", "Browser tabs serving a lookup",
+                       lambda: scraper_snapshot["tabs"]["in_use"])
+metrics.REGISTRY.gauge("scraper_tab_waiters", "Lookups waiting for a free tab",
+                       lambda: scraper_snapshot["tabs"]["waiting"])
+metrics.REGISTRY.gauge("scraper_browsers_running", "Browser instances up",
+                       lambda: sum(browser["running"] for browser in scraper_snapshot["browsers"]))
+metrics.REGISTRY.gauge("scraper_browser_rss_bytes", "Memory of all browser instances", lambda: scraper.rss())
+metrics.REGISTRY.gauge("scraper_in_flight", "Distinct nicks being scraped", lambda: scraper_snapshot["in_flight"])
+metrics.REGISTRY.gauge("scraper_coalesced_total", "Lookups that joined an in-flight scrape",
+                       lambda: scraper_snapshot["coalesced"], kind="counter")
+metrics.REGISTRY.gauge("upstream_rate", "Requests per second currently allowed towards warthunder.com",
+                       lambda: scraper_snapshot["upstream"]["rate"])
+metrics.REGISTRY.gauge("upstream_queued", "Lookups waiting for an upstream request slot",
+                       lambda: sum(scraper_snapshot["upstream"]["queued"].values()))
+metrics.REGISTRY.gauge("parse_queue_depth", "Pages waiting for or being parsed",
+                       lambda: scraper_snapshot["parse"]["pending"])
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    scraper_snapshot.clear()
+    # the service's numbers are fetched now, the ones supervise_browsers keeps can be a check interval old
+    scraper_snapshot.update(await scraper.fetch_stats() if SCRAPER_SOCKET else scraper.stats(rss=False))
+    # counters live in each worker process, the sum over all of them is what stays monotonic across scrapes
+    await publish_worker_metrics()
+    text = metrics.REGISTRY.render(await cache_backend.load_metrics())
+    if SCRAPER_SOCKET:
+        # stage timings and scrape outcomes are recorded where the scraping happens
+        text += await scraper.fetch_metrics()
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
 
 
 @app.get("/favicon.ico")
@@ -78,7 +644,31 @@ async def favicon():
     return None
 
 
-@repeat_every(seconds=60 * 60 * 24)
-async def clear_cache():
-    logging.info("Clearing cache")
-    await FastAPICache.clear("warthunder")
+@repeat_every(seconds=REFRESH_INTERVAL, wait_first=REFRESH_INTERVAL)
+async def refresh_hot_players():
+    await scheduler.run_once()
+
+
+async def publish_worker_metrics():
+    await cache_backend.publish_metrics(metrics_worker, metrics.REGISTRY.dump())
+
+
+@repeat_every(seconds=METRICS_INTERVAL, wait_first=METRICS_INTERVAL)
+async def publish_metrics():
+    await publish_worker_metrics()
+
+
+@repeat_every(seconds=60, wait_first=60)
+async def prune_cache():
+    removed = await cache_backend.prune(CACHE_MAX_ENTRIES)
+    if removed:
+        logging.info(f"Pruned {removed} cache entries")
+    if HISTORY_RETENTION_DAYS:
+        removed = await history.prune(time.time() - HISTORY_RETENTION_DAYS * 86400)
+        if removed:
+            logging.info(f"Pruned {removed} history rows")
+
+
+@repeat_every(seconds=BROWSER_CHECK_INTERVAL, wait_first=BROWSER_CHECK_INTERVAL)
+async def supervise_browsers():
+    await scraper.supervise()
@@ -0,0 +1,190 @@
+import bisect
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds, from a cache hit up to the 30 s page timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dump(self) -> list:
+        return [[list(label_values), value] for label_values, value in self.values.items()]
+
+    def merge(self, dumped: list):
+        for label_values, value in dumped:
+            self.inc(*label_values, amount=value)
+
+    def empty(self) -> "Counter":
+        return Counter(self.name, self.documentation, self.labels)
+
+    def render(self) -> list[str]:
+        # nothing is rendered before the first sample, the series may be reported by another process
+        if not self.values:
+            return []
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+# A value read from a callback at scrape time. kind="counter" exposes totals that are kept elsewhere.
+class Gauge:
+
+    def __init__(self, name: str, documentation: str, callback, kind: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        try:
+            value = self.callback()
+        except Exception as e:
+            logging.warning(f"Gauge {self.name} failed: {e!r}")
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.values = {}
+
+    def observe(self, value: float, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def dump(self) -> list:
+        return [[list(label_values), series] for label_values, series in self.values.items()]
+
+    def merge(self, dumped: list):
+        for label_values, (counts, total, count) in dumped:
+            series = self.values.setdefault(tuple(label_values), [[0] * (len(self.buckets) + 1), 0.0, 0])
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+            series[2] += count
+
+    def empty(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, self.labels, self.buckets)
+
+    def render(self) -> list[str]:
+        if not self.values:
+            return []
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                labels = _format_labels((*self.labels, "le"), (*label_values, bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, callback, kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, documentation, callback, kind))
+
+    def dump(self) -> str:
+        # the counters and histograms of this process, for the other worker processes to add up
+        return json.dumps({metric.name: metric.dump() for metric in self.metrics if hasattr(metric, "dump")})
+
+    def render(self, dumps: list[str] = None) -> str:
+        # given the dumps of every worker process (this one included), counters and histograms are rendered as their
+        # sum, so every scrape sees the same monotonic totals whichever worker answers it
+        dumps = [json.loads(dump) for dump in dumps or ()]
+        lines = []
+        for metric in self.metrics:
+            if dumps and hasattr(metric, "dump"):
+                merged = metric.empty()
+                for dump in dumps:
+                    merged.merge(dump.get(metric.name, []))
+                metric = merged
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "scraper_stage_seconds", "Time spent in each stage of a lookup", labels=("stage",)))
+SCRAPE_RESULTS = REGISTRY.register(Counter(
+    "scraper_results_total", "Upstream lookups by outcome", labels=("outcome",)))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "cache_lookups_total", "Player cache lookups by result", labels=("result",)))
+UPSTREAM_SHED = REGISTRY.register(Counter(
+    "upstream_shed_total", "Lookups rejected because the upstream queue was full", labels=("priority",)))
+BROWSER_RESTARTS = REGISTRY.register(Counter(
+    "browser_restarts_total", "Browser instances restarted by the supervisor", labels=("reason",)))
+
+# callables receiving (stage, seconds) for every timed stage, e.g. to feed an external profiler
+STAGE_HOOKS = []
+
+
+# Stage timings of one lookup. Every stage feeds STAGE_SECONDS, sampled traces are also logged as a breakdown.
+class Trace:
+
+    def __init__(self, name: str, sample_rate: float = 0):
+        self.name = name
+        self.sampled = sample_rate > 0 and random.random() < sample_rate
+        self.stages = []
+
+    @contextmanager
+    def stage(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: str, seconds: float):
+        STAGE_SECONDS.observe(seconds, stage)
+        for hook in STAGE_HOOKS:
+            hook(stage, seconds)
+        if self.sampled:
+            self.stages.append((stage, seconds))
+
+    def finish(self, outcome: str):
+        SCRAPE_RESULTS.inc(outcome)
+        if self.sampled:
+            breakdown = " ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in self.stages)
+            logging.info(f"Lookup of {self.name} ({outcome}): {breakdown}")
@@ -0,0 +1,222 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MODES = ("arcade", "realistic", "simulation")
+
+GENERAL_FIELDS = (
+    ("victories", 0), ("completed_missions", 0), ("victories_battles_ratio", "0%"), ("deaths", 0),
+    ("lions_earned", 0), ("play_time", "0m"), ("air_targets_destroyed", 0), ("ground_targets_destroyed", 0),
+    ("naval_targets_destroyed", 0),
+)
+AVIATION_FIELDS = (
+    ("air_battles", 0), ("air_battles_fighters", 0), ("air_battles_bombers", 0), ("air_battles_attackers", 0),
+    ("time_played_air_battles", "0m"), ("time_played_fighter", "0m"), ("time_played_bomber", "0m"),
+    ("time_played_attackers", "0m"), ("total_targets_destroyed", 0), ("air_targets_destroyed", 0),
+    ("ground_targets_destroyed", 0), ("naval_targets_destroyed", 0),
+)
+GROUND_FIELDS = (
+    ("ground_battles", 0), ("ground_battles_tanks", 0), ("ground_battles_spgs", 0),
+    ("ground_battles_heavy_tanks", 0), ("ground_battles_spaa", 0), ("time_played_ground_battles", "0m"),
+    ("tank_battle_time", "0m"), ("tank_destroyer_battle_time", "0m"), ("heavy_tank_battle_time", "0m"),
+    ("spaa_battle_time", "0m"), ("total_targets_destroyed", 0), ("air_targets_destroyed", 0),
+    ("ground_targets_destroyed", 0), ("naval_targets_destroyed", 0),
+)
+FLEET_FIELDS = (
+    ("naval_battles", 0), ("ship_battles", 0), ("motor_torpedo_boat_battles", 0), ("motor_gun_boat_battles", 0),
+    ("motor_torpedo_gun_boat_battles", 0), ("sub_chaser_battles", 0), ("destroyer_battles", 0),
+    ("naval_ferry_barge_battles", 0), ("time_played_naval", "0m"), ("time_played_on_ship", "0m"),
+    ("time_played_on_motor_torpedo_boat", "0m"), ("time_played_on_motor_gun_boat", "0m"),
+    ("time_played_on_motor_torpedo_gun_boat", "0m"), ("time_played_on_sub_chaser", "0m"),
+    ("time_played_on_destroyer", "0m"), ("time_played_on_naval_ferry_barge", "0m"), ("total_targets_destroyed", 0),
+    ("air_targets_destroyed", 0), ("ground_targets_destroyed", 0), ("naval_targets_destroyed", 0),
+)
+SECTIONS = (("aviation", AVIATION_FIELDS), ("ground", GROUND_FIELDS), ("fleet", FLEET_FIELDS))
+
+COUNTRIES = ("USA", "USSR", "GreatBritain", "Germany", "Japan", "Italy", "France", "China", "Sweden", "Israel")
+VEHICLE_FIELDS = ("owned_vehicles", "elite_vehicles", "medals")
+
+PROFILE_FIELDS = ("nickname", "register_date", "player_level", "clan_name", "clan_url", "avatar")
+# units the page can be parsed in, the nickname is always read since it tells whether the player exists
+SECTION_NAMES = ("profile", *(f"statistics.{mode}" for mode in MODES), "vehicles_and_rewards")
+# what each value of the fields= parameter needs parsed
+FIELD_SECTIONS = {
+    **{name: ("profile",) for name in PROFILE_FIELDS},
+    "statistics": tuple(f"statistics.{mode}" for mode in MODES),
+    **{f"statistics.{mode}": (f"statistics.{mode}",) for mode in MODES},
+    "vehicles_and_rewards": ("vehicles_and_rewards",),
+}
+
+# the hand-written template this table replaces defaulted this one field to 1, kept so responses do not change
+DEFAULT_OVERRIDES = {("simulation", "fleet", "naval_ferry_barge_battles"): 1}
+
+
+def _build_layout():
+    paths, defaults = [], []
+    for mode in MODES:
+        for name, default in GENERAL_FIELDS:
+            paths.append((mode, None, name))
+            defaults.append(default)
+        for section, fields in SECTIONS:
+            for name, default in fields:
+                paths.append((mode, section, name))
+                defaults.append(DEFAULT_OVERRIDES.get((mode, section, name), default))
+    for country in COUNTRIES:
+        for name in VEHICLE_FIELDS:
+            paths.append((country, None, name))
+            defaults.append(0)
+    return tuple(paths), tuple(defaults)
+
+
+# every statistic lives at a fixed position of PlayerStats.values, in the order the JSON object lists them
+PATHS, DEFAULTS = _build_layout()
+INDEX = {path: i for i, path in enumerate(PATHS)}
+# the per-country vehicle counters come after all per-mode statistics
+_VEHICLES = len(PATHS) - len(COUNTRIES) * len(VEHICLE_FIELDS)
+
+
+def stat_index(mode: str, section: str | None, name: str) -> int:
+    return INDEX[(mode, section, name)]
+
+
+def vehicle_index(country: str, name: str) -> int:
+    return INDEX[(country, None, name)]
+
+
+class PlayerStats:
+    __slots__ = ("nickname", "register_date", "player_level", "clan_name", "clan_url", "avatar", "values")
+
+    def __init__(self):
+        self.nickname = ""
+        self.register_date = ""
+        self.player_level = 0
+        self.clan_name = ""
+        self.clan_url = ""
+        self.avatar = ""
+        self.values = list(DEFAULTS)
+
+    def to_dict(self) -> dict:
+        values = iter(self.values)
+        statistics = {}
+        for mode in MODES:
+            stats = statistics[mode] = {name: next(values) for name, _ in GENERAL_FIELDS}
+            for section, fields in SECTIONS:
+                stats[section] = {name: next(values) for name, _ in fields}
+        vehicles_and_rewards = {country: {name: next(values) for name in VEHICLE_FIELDS} for country in COUNTRIES}
+        return {
+            "nickname": self.nickname,
+            "register_date": self.register_date,
+            "player_level": self.player_level,
+            "clan_name": self.clan_name,
+            "clan_url": self.clan_url,
+            "avatar": self.avatar,
+            "statistics": statistics,
+            "vehicles_and_rewards": vehicles_and_rewards,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PlayerStats":
+        stats = cls()
+        for name in PROFILE_FIELDS:
+            setattr(stats, name, data[name])
+        stats.values = [data["statistics"][mode][name] if section is None
+                        else data["statistics"][mode][section][name] for mode, section, name in PATHS[:_VEHICLES]]
+        stats.values.extend(data["vehicles_and_rewards"][country][name] for country, _, name in PATHS[_VEHICLES:])
+        return stats
+
+
+def sections_for(fields: list[str]) -> tuple:
+    return tuple(section for section in SECTION_NAMES
+                 if any(section in FIELD_SECTIONS[field] for field in fields))
+
+
+def extract_section(data: dict, section: str) -> dict:
+    # the part of a to_dict() result a section fills in, shaped like the full object
+    if section == "profile":
+        return {name: data[name] for name in PROFILE_FIELDS}
+    top, _, sub = section.partition(".")
+    return {top: {sub: data[top][sub]}} if sub else {top: data[top]}
+
+
+def merge_sections(parts) -> dict:
+    data = {}
+    for part in parts:
+        for key, value in part.items():
+            if isinstance(value, dict) and key in data:
+                data[key].update(value)
+            else:
+                data[key] = value
+    return data
+
+
+def select_fields(data: dict, fields: list[str]) -> dict:
+    selected = {}
+    for field in fields:
+        top, _, sub = field.partition(".")
+        if sub:
+            selected.setdefault(top, {})[sub] = data[top][sub]
+        else:
+            selected[top] = data[top]
+    return selected
+
+
+def _count(value) -> int:
+    # counters the page showed as N/A keep their string default
+    return value if isinstance(value, int) else 0
+
+
+def _with_kd(totals: dict) -> dict:
+    totals["kd"] = round(totals["kills"] / totals["deaths"], 3) if totals["deaths"] else None
+    return totals
+
+
+def player_summary(data: dict) -> dict:
+    # the per-mode numbers /clan reports for every member of a squadron
+    summary = {"player_level": data["player_level"]}
+    for mode in MODES:
+        stats = data["statistics"][mode]
+        summary[mode] = _with_kd({
+            "battles": sum(_count(stats[section][f"{name}_battles"])
+                           for section, name in (("aviation", "air"), ("ground", "ground"), ("fleet", "naval"))),
+            "victories": _count(stats["victories"]),
+            "kills": sum(_count(stats[f"{kind}_targets_destroyed"]) for kind in ("air", "ground", "naval")),
+            "deaths": _count(stats["deaths"]),
+        })
+    return summary
+
+
+def squadron_totals(summaries: list[dict]) -> dict:
+    totals = {"average_level": round(sum(s["player_level"] for s in summaries) / len(summaries), 1)
+              if summaries else None}
+    for mode in MODES:
+        totals[mode] = _with_kd({key: sum(s[mode][key] for s in summaries)
+                                 for key in ("battles", "victories", "kills", "deaths")})
+    return totals
+
+
+def _default(obj):
+    if isinstance(obj, PlayerStats):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def encode(result) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(result, default=_default)
+    # same compact form FastAPI's JSONResponse produces
+    return json.dumps(result, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode(body: bytes):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def decode_result(body: bytes):
+    # inverse of encode for scrape results, the player statistics come back as PlayerStats
+    result = decode(body)
+    if result and isinstance(result.get("data"), dict):
+        result["data"] = PlayerStats.from_dict(result["data"])
+    return result
@@ -0,0 +1,335 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+import traceback
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from bs4 import BeautifulSoup
+
+from models import (COUNTRIES, GENERAL_FIELDS, MODES, SECTION_NAMES, SECTIONS, VEHICLE_FIELDS, PlayerStats,
+                    stat_index, vehicle_index)
+
+try:
+    from cssselect import HTMLTranslator
+    from lxml import html as lxml_html
+    from lxml.etree import XPath
+except ImportError:
+    lxml_html = None
+
+GENERAL_SELECTORS = {
+    "arcade": "div.community__user-rate.user-rate > div.user-profile__stat.user-stat > div > ul.user-stat__list.arcadeFightTab > li",
+    "realistic": "div.community__user-rate.user-rate > div.user-profile__stat.user-stat > div > ul.user-stat__list.historyFightTab > li",
+    "simulation": "div.community__user-rate.user-rate > div.user-profile__stat.user-stat > div > ul.user-stat__list.simulationFightTab > li",
+}
+VEHICLE_SELECTORS = {
+    "owned_vehicles": "div.user-profile__score.user-score > ul:nth-child(2) > li",
+    "elite_vehicles": "div.user-profile__score.user-score > ul:nth-child(3) > li",
+    "medals": "div.user-profile__score.user-score > ul:nth-child(4) > li",
+}
+
+# every selector analyze_html uses, so the lxml backend can compile them once at import time
+SELECTORS = [
+    "li.user-profile__data-nick",
+    "div.user-profile > ul > li",
+    "div.user-profile > div > img",
+    *GENERAL_SELECTORS.values(),
+    "div.user-rate__fightType > div > div.user-stat__list-row",
+    "ul.user-stat__list",
+    "li",
+    *VEHICLE_SELECTORS.values(),
+    "div.squadrons-members__table",
+    "div.squadrons-members__grid-item",
+    "div.squadrons-info__title",
+]
+
+
+class BeautifulSoupDocument:
+
+    def __init__(self, html: str):
+        self.root = BeautifulSoup(html, "html.parser")
+
+    @staticmethod
+    def select(node, selector: str) -> list:
+        return node.select(selector)
+
+    @staticmethod
+    def first(node, tag: str):
+        return node.find(tag)
+
+    @staticmethod
+    def text(node) -> str:
+        return node.get_text(strip=True)
+
+    @staticmethod
+    def attr(node, name: str) -> str:
+        return node.get(name, "")
+
+
+if lxml_html is not None:
+    # "descendant::" rather than the default "descendant-or-self::" to match soupsieve, which never matches the
+    # node select() is called on
+    _COMPILED = {selector: XPath(HTMLTranslator().css_to_xpath(selector, prefix="descendant::"))
+                 for selector in SELECTORS}
+    # text nodes only, comments and processing instructions are skipped like BeautifulSoup does
+    _TEXT = XPath("descendant::text()")
+
+
+class LxmlDocument:
+
+    def __init__(self, html: str):
+        # lxml refuses empty documents where html.parser yields an empty tree
+        self.root = lxml_html.document_fromstring(html) if html.strip() else lxml_html.Element("html")
+
+    @staticmethod
+    def select(node, selector: str) -> list:
+        return _COMPILED[selector](node)
+
+    @staticmethod
+    def first(node, tag: str):
+        return node.find(f".//{tag}")
+
+    @staticmethod
+    def text(node) -> str:
+        return "".join(s for s in (t.strip() for t in _TEXT(node)) if s)
+
+    @staticmethod
+    def attr(node, name: str) -> str:
+        return node.get(name, "")
+
+
+PARSERS = {"bs4": BeautifulSoupDocument}
+if lxml_html is not None:
+    PARSERS["lxml"] = LxmlDocument
+
+DEFAULT_PARSER = "lxml" if "lxml" in PARSERS else "bs4"
+
+
+def get_document_class(name: str = None):
+    name = name or DEFAULT_PARSER
+    if name not in PARSERS:
+        logging.warning(f"HTML parser \"{name}\" is not available, falling back to bs4")
+        name = "bs4"
+    return PARSERS[name]
+
+
+def _set_stat(values: list, index: int, stat: str):
+    if stat.isdigit():
+        values[index] = int(stat)
+    elif stat != "N/A":
+        values[index] = stat
+
+
+# bump whenever a change to the parsing changes its output, results cached by older versions are then re-derived
+# from the stored page snapshots
+PARSER_VERSION = 1
+
+
+def compress_html(html: str) -> bytes:
+    return zlib.compress(html.encode("utf-8"), 6)
+
+
+def decompress_html(snapshot: bytes) -> str:
+    return zlib.decompress(snapshot).decode("utf-8")
+
+
+def _parse_profile(doc, data: PlayerStats):
+    # Get player register date, player level, clan name and clan url
+    res = doc.select(doc.root, "div.user-profile > ul > li")
+    data.register_date = doc.text(res[-1])[18:]
+    data.player_level = int(doc.text(res[-2])[6:])
+    if len(res) == 5:  # has clan
+        data.clan_name = doc.text(res[1])
+        data.clan_url = f"https://warthunder.com{doc.attr(doc.first(res[1], 'a'), 'href')}"
+
+    # Get player avatar
+    res = doc.select(doc.root, "div.user-profile > div > img")
+    data.avatar = doc.attr(res[0], "src")
+
+
+def _parse_statistics(doc, values: list, mode: str):
+    # general statistics
+    res = doc.select(doc.root, GENERAL_SELECTORS[mode])
+    for i in range(1, len(res)):
+        _set_stat(values, stat_index(mode, None, GENERAL_FIELDS[i - 1][0]), doc.text(res[i]).replace(",", ""))
+
+    # specific statistics: aviation, ground and fleet rows, one list per mode after the titles column
+    column = MODES.index(mode) + 1
+    three_modes = doc.select(doc.root, "div.user-rate__fightType > div > div.user-stat__list-row")
+    for row, (section, fields) in enumerate(SECTIONS):
+        res = doc.select(three_modes[row], "ul.user-stat__list")
+        if column < len(res):
+            stats = doc.select(res[column], "li")
+            for j in range(len(stats)):
+                _set_stat(values, stat_index(mode, section, fields[j][0]), doc.text(stats[j]).replace(",", ""))
+
+
+def _parse_vehicles(doc, values: list):
+    # vehicles and rewards
+    for name in VEHICLE_FIELDS:
+        res = doc.select(doc.root, VEHICLE_SELECTORS[name])
+        for i in range(1, len(res)):
+            values[vehicle_index(COUNTRIES[i - 1], name)] = int(doc.text(res[i]).replace(",", ""))
+
+
+def analyze_html(html: str, parser: str = None, sections: tuple = SECTION_NAMES) -> dict:
+    # only the given sections are filled in, the others keep their defaults
+    document_class = get_document_class(parser)
+    data = PlayerStats()
+    values = data.values
+    try:
+        doc = document_class(html)
+
+        output = {"code": 200,
+                  "message": "Success",
+                  "tip": "Fk cf!",
+                  "data": data}
+
+        # Get nickname while checking if the player exists
+        res = doc.select(doc.root, "li.user-profile__data-nick")
+        if len(res) == 0:
+            output["code"] = 404
+            output["message"] = "Player not found"
+            output["tip"] = "The nickname is case sensitive. Please check the nickname and try again."
+            return output
+
+        data.nickname = doc.text(res[0])
+
+        if "profile" in sections:
+            _parse_profile(doc, data)
+        for mode in MODES:
+            if f"statistics.{mode}" in sections:
+                _parse_statistics(doc, values, mode)
+        if "vehicles_and_rewards" in sections:
+            _parse_vehicles(doc, values)
+
+        return output
+
+    except Exception as e:
+        logging.error(e)
+        logging.error(traceback.format_exc())
+        return {"code": 500, "message": "Internal Server Error", "tip": "Please try again later."}
+
+
+# the squadron roster is a grid of cells, six per member after a row of column titles:
+# number, nick, personal clan rating, activity, role, date of entry
+CLAN_COLUMNS = 6
+
+
+def _count(text: str):
+    text = text.replace(",", "")
+    return int(text) if text.isdigit() else None
+
+
+def analyze_clan_html(html: str, parser: str = None) -> dict:
+    document_class = get_document_class(parser)
+    try:
+        doc = document_class(html)
+        table = doc.select(doc.root, "div.squadrons-members__table")
+        if len(table) == 0:
+            return {"code": 404, "message": "Squadron not found",
+                    "tip": "The squadron name is case sensitive. Please check the name and try again.", "data": None}
+
+        title = doc.select(doc.root, "div.squadrons-info__title")
+        cells = doc.select(table[0], "div.squadrons-members__grid-item")
+        members = []
+        for i in range(CLAN_COLUMNS, len(cells) - CLAN_COLUMNS + 1, CLAN_COLUMNS):
+            members.append({
+                "nickname": doc.text(cells[i + 1]),
+                "rating": _count(doc.text(cells[i + 2])),
+                "activity": _count(doc.text(cells[i + 3])),
+                "role": doc.text(cells[i + 4]),
+                "joined": doc.text(cells[i + 5]),
+            })
+        return {"code": 200, "message": "Success", "tip": "Fk cf!",
+                "data": {"name": doc.text(title[0]) if title else "", "members": members}}
+
+    except Exception as e:
+        logging.error(e)
+        logging.error(traceback.format_exc())
+        return {"code": 500, "message": "Internal Server Error", "tip": "Please try again later."}
+
+
+class ParseQueueFull(Exception):
+    pass
+
+
+def _timed(fn, *args) -> tuple[float, dict]:
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+class ParsePool:
+
+    def __init__(self, workers: int = 2, max_pending: int = 32, parser: str = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.parser = parser
+        self.pending = 0
+        self.parsed = 0
+        self.parse_seconds = 0.0
+        self.max_parse_seconds = 0.0
+        self.queue_seconds = 0.0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn rather than fork, the parent holds browser websockets and threads
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "parsed": self.parsed,
+            "avg_parse_ms": round(self.parse_seconds / self.parsed * 1000, 2) if self.parsed else 0,
+            "max_parse_ms": round(self.max_parse_seconds * 1000, 2),
+            "avg_queue_ms": round(self.queue_seconds / self.parsed * 1000, 2) if self.parsed else 0,
+        }
+
+    async def analyze_html(self, html: str, trace=None, sections: tuple = SECTION_NAMES) -> dict:
+        return await self._run(trace, analyze_html, html, self.parser, sections)
+
+    async def analyze_clan_html(self, html: str, trace=None) -> dict:
+        return await self._run(trace, analyze_clan_html, html, self.parser)
+
+    async def _run(self, trace, fn, *args) -> dict:
+        if self.pending >= self.max_pending:
+            raise ParseQueueFull(f"{self.pending} pages are already waiting to be parsed")
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            if self.workers > 0:
+                # the page is pickled once into the worker, nothing else crosses the process boundary
+                elapsed, result = await asyncio.get_running_loop().run_in_executor(
+                    self._get_executor(), _timed, fn, *args)
+            else:
+                elapsed, result = _timed(fn, *args)
+        finally:
+            self.pending -= 1
+        self.parsed += 1
+        self.parse_seconds += elapsed
+        self.max_parse_seconds = max(self.max_parse_seconds, elapsed)
+        queued = max(time.perf_counter() - start - elapsed, 0)
+        self.queue_seconds += queued
+        if trace is not None:
+            trace.record("parse_queue", queued)
+            trace.record("parse", elapsed)
+        return result
+
+    async def warm_up(self):
+        # spawned workers import lxml and the selectors on their first job, run that ahead of the first page
+        if self.workers > 0:
+            executor = self._get_executor()
+            await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(executor, _timed, len, "")
+                                   for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class Popularity:
+    score: float = 0.0
+    last_access: float = 0.0
+    stale_at: float = 0.0
+
+
+# Every access bumps an exponentially decaying popularity score. Players above min_score whose cache entry turns
+# stale within lead seconds are re-scraped ahead of time while the browser has idle tabs, limited to
+# budget_per_minute upstream requests. Scores only count the accesses this process served; the budget is per
+# process too unless take_token, an async callable, hands out tokens from a bucket shared by all of them.
+class RefreshScheduler:
+
+    def __init__(self, refresh, idle_capacity, lead: float = 60, budget_per_minute: int = 30, min_score: float = 2,
+                 half_life: float = 3600, max_tracked: int = 10000, take_token=None):
+        self.refresh = refresh
+        self.take_token = take_token
+        self.idle_capacity = idle_capacity
+        self.lead = lead
+        self.budget_per_minute = budget_per_minute
+        self.min_score = min_score
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+        self.players: dict[str, Popularity] = {}
+        self.proactive = 0
+        self.demand = 0
+        self.over_budget = 0
+        self._tokens = float(budget_per_minute)
+        self._tokens_at = time.monotonic()
+        self._tasks = set()
+
+    def _decayed(self, player: Popularity, now: float) -> float:
+        return player.score * 0.5 ** ((now - player.last_access) / self.half_life)
+
+    def record_access(self, name: str, stale_at: float = 0):
+        now = time.time()
+        player = self.players.get(name)
+        if player is None:
+            if len(self.players) >= self.max_tracked:
+                self._evict(now)
+            player = self.players[name] = Popularity()
+        player.score = self._decayed(player, now) + 1
+        player.last_access = now
+        if stale_at:
+            player.stale_at = stale_at
+
+    def record_refresh(self, name: str, stale_at: float, proactive: bool = False):
+        if proactive:
+            self.proactive += 1
+        else:
+            self.demand += 1
+        player = self.players.get(name)
+        if player is not None:
+            player.stale_at = stale_at
+
+    def _evict(self, now: float):
+        # drop the coldest tenth so that eviction is not paid on every new player
+        coldest = sorted(self.players, key=lambda name: self._decayed(self.players[name], now))
+        for name in coldest[:max(len(coldest) // 10, 1)]:
+            del self.players[name]
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._tokens_at) * self.budget_per_minute / 60,
+                           self.budget_per_minute)
+        self._tokens_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def stats(self) -> dict:
+        return {"tracked": len(self.players), "proactive_refreshes": self.proactive,
+                "demand_refreshes": self.demand, "skipped_over_budget": self.over_budget}
+
+    async def run_once(self):
+        now = time.time()
+        due = [(self._decayed(player, now), name) for name, player in self.players.items()
+               if player.stale_at and player.stale_at - now <= self.lead]
+        due = sorted((item for item in due if item[0] >= self.min_score), reverse=True)
+        capacity = self.idle_capacity()
+        for _, name in due[:capacity]:
+            if not (await self.take_token() if self.take_token else self._take_token()):
+                self.over_budget += 1
+                break
+            # forget the expiry until the refresh reports back, so a slow refresh is not scheduled twice
+            self.players[name].stale_at = 0
+            task = asyncio.create_task(self._refresh(name))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, name: str):
+        try:
+            await self.refresh(name)
+        except Exception as e:
+            logging.error(f"Proactive refresh of {name} failed: {e!r}")
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+
+import aiohttp
+from aiohttp import web
+
+import metrics
+import models
+from config import (ALLOW_URLS, BLOCK_RESOURCES, BLOCK_URLS, BROWSER_CHECK_INTERVAL, BROWSER_MAX_PAGES,
+                    BROWSER_MAX_RSS_MB, COOKIE_TTL, HTML_PARSER, HTTP_FAST_PATH, PARSE_QUEUE, PARSE_WORKERS,
+                    PROFILE_SAMPLE_RATE, PROXY_HOST, PROXY_PORT, READY_SELECTOR, SCRAPER_BROWSERS, SCRAPER_SOCKET,
+                    SCRAPER_TAB_TIMEOUT, SCRAPER_TABS, UPSTREAM_BURST, UPSTREAM_RATE, UPSTREAM_URL,
+                    UPSTREAM_WAIT_BACKGROUND, UPSTREAM_WAIT_BATCH, UPSTREAM_WAIT_INTERACTIVE, WARMUP, WARMUP_NICK,
+                    WARMUP_TIMEOUT)
+from scraping import SERVER_BUSY, Scraping
+from upstream import Ticket
+
+# cached profile pages are sent back here to be re-parsed, they can be well over aiohttp's 1 MiB default
+MAX_SNAPSHOT_SIZE = 16 * 2 ** 20
+# answered before the service reported anything, shaped like Scraping.stats()
+EMPTY_STATS = {"tabs": {"size": 0, "in_use": 0, "available": 0, "waiting": 0}, "browsers": [], "in_flight": 0,
+               "coalesced": 0, "parse": {"pending": 0}, "blocked_requests": 0, "http": None,
+               "upstream": {"rate": 0, "factor": 1, "queued": {}, "admitted": {}, "shed": {}}}
+
+
+def create_scraper() -> Scraping:
+    return Scraping(proxy_host=PROXY_HOST, proxy_port=PROXY_PORT, pool_size=SCRAPER_TABS,
+                    pool_timeout=SCRAPER_TAB_TIMEOUT, parser=HTML_PARSER, parse_workers=PARSE_WORKERS,
+                    parse_queue=PARSE_QUEUE, block_resources=BLOCK_RESOURCES, block_urls=BLOCK_URLS,
+                    allow_urls=ALLOW_URLS, ready_selector=READY_SELECTOR, http_fast_path=HTTP_FAST_PATH,
+                    cookie_ttl=COOKIE_TTL, sample_rate=PROFILE_SAMPLE_RATE, base_url=UPSTREAM_URL,
+                    browsers=SCRAPER_BROWSERS, max_pages=BROWSER_MAX_PAGES, max_rss=BROWSER_MAX_RSS_MB * 2 ** 20,
+                    upstream_rate=UPSTREAM_RATE, upstream_burst=UPSTREAM_BURST,
+                    wait_budgets={"interactive": UPSTREAM_WAIT_INTERACTIVE, "batch": UPSTREAM_WAIT_BATCH,
+                                  "background": UPSTREAM_WAIT_BACKGROUND})
+
+
+# The scraping engine as its own process: every API worker on the node sends its lookups here over a Unix socket,
+# so there is one set of browsers, one parse pool and one in-flight table however many workers serve the API.
+def create_app(scraper: Scraping) -> web.Application:
+    app = web.Application(client_max_size=MAX_SNAPSHOT_SIZE)
+    # the API workers wait for this before they report ready themselves
+    warmup = {"ready": not WARMUP, "report": None, "error": None}
+
+    async def player(request: web.Request) -> web.Response:
+        result = await scraper.get_player_stat(request.query["nick"], request.query.get("priority", "interactive"))
+        return web.Response(body=models.encode(result), content_type="application/json",
+                            headers={"X-Idle-Capacity": str(scraper.idle_capacity())})
+
+    async def promote(request: web.Request) -> web.Response:
+        # only raises a scrape that is in flight, it never starts one
+        scraper.flights.promote(request.query["nick"], request.query["priority"])
+        return web.Response(status=204)
+
+    async def clan(request: web.Request) -> web.Response:
+        result = await scraper.get_clan(request.query["name"], request.query.get("priority", "interactive"))
+        return web.Response(body=models.encode(result), content_type="application/json",
+                            headers={"X-Idle-Capacity": str(scraper.idle_capacity())})
+
+    async def snapshot(request: web.Request) -> web.Response:
+        # parsed in the service's pool, so the API workers' event loops and CPUs are left to serving requests
+        result = await scraper.analyze_snapshot(await request.text(), tuple(request.query["sections"].split(",")))
+        return web.Response(body=models.encode(result), content_type="application/json")
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.Response(body=models.encode(await scraper.fetch_stats()), content_type="application/json")
+
+    async def ready(request: web.Request) -> web.Response:
+        return web.Response(body=models.encode(warmup), content_type="application/json",
+                            status=200 if warmup["ready"] else 503)
+
+    async def warm_up():
+        # out of time is ready anyway, like a cold start; browsers that fail to start keep /ready at 503 until a
+        # later attempt gets them up
+        while True:
+            try:
+                warmup["report"] = await asyncio.wait_for(scraper.warm_up(WARMUP_NICK), WARMUP_TIMEOUT)
+                warmup["error"] = None
+                logging.info(f"Scraper warmed up: {warmup['report']}")
+            except TimeoutError:
+                logging.warning(f"Scraper warm-up did not finish within {WARMUP_TIMEOUT}s")
+                warmup["error"] = "timeout"
+            except Exception as e:
+                logging.error(f"Scraper warm-up failed, retrying in {BROWSER_CHECK_INTERVAL}s: {e!r}")
+                warmup["error"] = repr(e)
+                await asyncio.sleep(BROWSER_CHECK_INTERVAL)
+                continue
+            break
+        warmup["ready"] = True
+
+    async def prometheus_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.REGISTRY.render(), content_type="text/plain")
+
+    async def supervise():
+        while True:
+            await asyncio.sleep(BROWSER_CHECK_INTERVAL)
+            try:
+                await scraper.supervise()
+            except Exception as e:
+                logging.error(f"Browser supervision failed: {e!r}")
+
+    async def background(_: web.Application):
+        tasks = [asyncio.create_task(supervise())]
+        if WARMUP:
+            tasks.append(asyncio.create_task(warm_up()))
+        yield
+        for task in tasks:
+            task.cancel()
+        await scraper.close()
+
+    app.router.add_get("/player", player)
+    app.router.add_get("/promote", promote)
+    app.router.add_get("/clan", clan)
+    app.router.add_post("/snapshot", snapshot)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", prometheus_metrics)
+    app.cleanup_ctx.append(background)
+    return app
+
+
+# Stands in for Scraping inside the API workers when SCRAPER_SOCKET is set. The synchronous stats() and
+# idle_capacity() answer from the last numbers the service reported.
+class ScraperClient:
+
+    def __init__(self, path: str, timeout: float = 120):
+        self.path = path
+        self.timeout = timeout
+        self._stats = EMPTY_STATS
+        self._idle_capacity = 0
+        self._session = None
+        self._tasks = set()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=self.path),
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def get_player_stat(self, name: str, priority: str | Ticket = "interactive"):
+        ticket = priority if isinstance(priority, Ticket) else Ticket(priority)
+
+        def promote(to: str):
+            # a more urgent caller joined this lookup in the worker, the scrape in the service follows
+            task = asyncio.create_task(self._promote(name, to))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        ticket.watch(promote)
+        try:
+            async with self._get_session().get("http://scraper/player",
+                                               params={"nick": name, "priority": ticket.priority}) as response:
+                response.raise_for_status()
+                body = await response.read()
+                self._idle_capacity = int(response.headers.get("X-Idle-Capacity", 0))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Scraper service failed for {name}: {e!r}")
+            return None
+        finally:
+            ticket.unwatch(promote)
+        return models.decode_result(body)
+
+    async def _promote(self, name: str, priority: str):
+        try:
+            async with self._get_session().get("http://scraper/promote",
+                                               params={"nick": name, "priority": priority}) as response:
+                response.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Failed to raise the priority of {name}: {e!r}")
+
+    async def get_clan(self, name: str, priority: str = "interactive"):
+        try:
+            async with self._get_session().get("http://scraper/clan",
+                                               params={"name": name, "priority": priority}) as response:
+                response.raise_for_status()
+                body = await response.read()
+                self._idle_capacity = int(response.headers.get("X-Idle-Capacity", 0))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Scraper service failed for squadron {name}: {e!r}")
+            return None
+        return models.decode(body)
+
+    async def fetch_stats(self) -> dict:
+        try:
+            async with self._get_session().get("http://scraper/stats") as response:
+                response.raise_for_status()
+                self._stats = models.decode(await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Scraper service stats unavailable: {e!r}")
+        return self._stats
+
+    async def fetch_metrics(self) -> str:
+        try:
+            async with self._get_session().get("http://scraper/metrics") as response:
+                response.raise_for_status()
+                return await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Scraper service metrics unavailable: {e!r}")
+            return ""
+
+    async def warm_up(self, nick: str = None) -> dict:
+        # the service warms itself up when it starts, the worker only waits for it to be done; a failed attempt is
+        # passed on so the worker does not report ready on top of a service without browsers
+        while True:
+            try:
+                async with self._get_session().get("http://scraper/ready") as response:
+                    warmup = models.decode(await response.read())
+                if warmup["ready"]:
+                    return warmup["report"]
+                if warmup["error"]:
+                    raise RuntimeError(f"Scraper service warm-up failed: {warmup['error']}")
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # not listening yet
+                pass
+            await asyncio.sleep(1)
+
+    async def analyze_snapshot(self, html: str, sections: tuple) -> dict:
+        try:
+            async with self._get_session().post("http://scraper/snapshot", params={"sections": ",".join(sections)},
+                                                data=html.encode(),
+                                                headers={"Content-Type": "text/html; charset=utf-8"}) as response:
+                response.raise_for_status()
+                return models.decode_result(await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Scraper service failed to parse a snapshot: {e!r}")
+            # answered like a saturated parse pool, scraping the page again would go through the same service
+            return dict(SERVER_BUSY, retry_after=1)
+
+    def stats(self, rss: bool = True) -> dict:
+        return self._stats
+
+    def rss(self) -> int:
+        return sum(browser["rss_mb"] or 0 for browser in self._stats["browsers"]) * 2 ** 20
+
+    def idle_capacity(self) -> int:
+        return self._idle_capacity
+
+    async def supervise(self):
+        # the service supervises its browsers itself, this only keeps the reported numbers fresh
+        await self.fetch_stats()
+        self._idle_capacity = max(self._stats["tabs"]["available"] - self._stats["tabs"]["waiting"], 0)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO", format='%(process)d | %(levelname)s | %(asctime)s | %(name)s | %(message)s')
+    if not SCRAPER_SOCKET:
+        raise SystemExit("SCRAPER_SOCKET must be set to the path of the Unix socket to listen on")
+    web.run_app(create_app(create_scraper()), path=SCRAPER_SOCKET)
@@ -1,8 +1,27 @@
+import asyncio
+import fnmatch
+import json
 import logging
+import time
 import traceback
+from contextlib import asynccontextmanager
+from urllib.parse import quote
 
 import zendriver as zd
-from bs4 import BeautifulSoup
+from zendriver import cdp
+from zendriver.core.connection import ProtocolException
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+import metrics
+import parsing
+from fetcher import PROFILE_MARKER, SQUADRON_MARKER, HttpFetcher
+from upstream import Overloaded, Ticket, UpstreamScheduler
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36"
 
 
 class Singleton(type):
@@ -14,442 +33,572 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class PoolExhausted(Exception):
+    pass
+
+
+class RequestBlocker:
+
+    def __init__(self, resource_types: list[str] = None, block_urls: list[str] = None, allow_urls: list[str] = None):
+        self.resource_types = {cdp.network.ResourceType(t) for t in resource_types or []}
+        self.block_urls = block_urls or []
+        self.allow_urls = allow_urls or []
+        self.blocked = 0
+
+    async def attach(self, tab):
+        if self.block_urls:
+            await tab.send(cdp.network.enable())
+            await tab.send(cdp.network.set_blocked_ur_ls(urls=self.block_urls))
+        if self.resource_types:
+            tab.add_handler(cdp.fetch.RequestPaused, self._on_request_paused)
+            await tab.send(cdp.fetch.enable(patterns=[cdp.fetch.RequestPattern(url_pattern="*", resource_type=t)
+                                                      for t in self.resource_types]))
+
+    def _on_request_paused(self, event: cdp.fetch.RequestPaused, tab):
+        # feed_cdp instead of send, the paused request holds up the page until it is answered
+        url = event.request.url
+        if event.resource_type in self.resource_types and not any(fnmatch.fnmatch(url, p) for p in self.allow_urls):
+            self.blocked += 1
+            tab.feed_cdp(cdp.fetch.fail_request(event.request_id, cdp.network.ErrorReason.BLOCKED_BY_CLIENT))
+        else:
+            tab.feed_cdp(cdp.fetch.continue_request(event.request_id))
+
+
+class TabPool:
+
+    def __init__(self, browser, size: int = 4, timeout: float = 30, prepare=None):
+        self.browser = browser
+        self.size = size
+        self.timeout = timeout
+        self.prepare = prepare
+        self.waiting = 0
+        self._idle = asyncio.Queue()
+
+    async def open(self):
+        for _ in range(self.size):
+            self._idle.put_nowait(await self._new_tab())
+
+    async def _new_tab(self):
+        tab = await self.browser.get("about:blank", new_tab=True)
+        if self.prepare is not None:
+            await self.prepare(tab)
+        return tab
+
+    @property
+    def available(self) -> int:
+        return self._idle.qsize()
+
+    @property
+    def in_use(self) -> int:
+        return self.size - self.available
+
+    def stats(self) -> dict:
+        return {"size": self.size, "in_use": self.in_use, "available": self.available, "waiting": self.waiting}
+
+    @asynccontextmanager
+    async def tab(self, trace: metrics.Trace = None, timeout: float = None):
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            tab = await asyncio.wait_for(self._idle.get(), timeout=timeout)
+        except TimeoutError:
+            raise PoolExhausted(f"No free tab within {timeout}s")
+        finally:
+            self.waiting -= 1
+            if trace is not None:
+                trace.record("tab_wait", time.perf_counter() - start)
+        healthy = False
+        try:
+            yield tab
+            healthy = True
+        finally:
+            if not healthy:
+                # the tab may be stuck mid-navigation, replace it instead of handing it to the next request
+                try:
+                    await tab.close()
+                except Exception:
+                    pass
+                try:
+                    tab = await self._new_tab()
+                except Exception as e:
+                    logging.error(f"Failed to reopen tab: {e}")
+                    self.size -= 1
+                    tab = None
+            if tab is not None:
+                self._idle.put_nowait(tab)
+
+
+# One Chrome process and its tab pool, with the page count and memory the supervisor recycles it on.
+class BrowserInstance:
+
+    def __init__(self, index: int, launch, pool_size: int = 4, pool_timeout: float = 30, prepare=None):
+        self.index = index
+        self.launch = launch
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.prepare = prepare
+        self.browser = None
+        self.pool = None
+        self.pages = 0
+        self.restarts = 0
+        self.started_at = 0.0
+        self.restarting = False
+
+    @property
+    def running(self) -> bool:
+        return self.pool is not None
+
+    async def start(self):
+        browser = await self.launch()
+        pool = TabPool(browser, size=self.pool_size, timeout=self.pool_timeout, prepare=self.prepare)
+        try:
+            await pool.open()
+        except Exception:
+            await browser.stop()
+            raise
+        self.browser, self.pool = browser, pool
+        self.pages = 0
+        self.started_at = time.monotonic()
+
+    async def stop(self):
+        browser, self.browser, self.pool = self.browser, None, None
+        await self._stop_browser(browser)
+
+    @staticmethod
+    async def _stop_browser(browser):
+        if browser is None:
+            return
+        try:
+            await browser.stop()
+        except Exception as e:
+            logging.warning(f"Failed to stop browser: {e!r}")
+
+    async def alive(self, timeout: float) -> bool:
+        if self.browser is None or self.browser.stopped or self.pool.size == 0:
+            return False
+        try:
+            await asyncio.wait_for(self.browser.connection.send(cdp.browser.get_version()), timeout)
+        except Exception:
+            return False
+        return True
+
+    def rss(self) -> int:
+        # the browser process plus its renderer, GPU and utility children
+        if psutil is None or self.browser is None or not self.browser._process_pid:
+            return 0
+        try:
+            process = psutil.Process(self.browser._process_pid)
+            return sum(p.memory_info().rss for p in (process, *process.children(recursive=True)))
+        except psutil.Error:
+            return 0
+
+    def stats(self, rss: bool = True) -> dict:
+        return {"index": self.index, "running": self.running, "pages": self.pages, "restarts": self.restarts,
+                "rss_mb": round(self.rss() / 2 ** 20) if rss else None,
+                "uptime": round(time.monotonic() - self.started_at) if self.running else None,
+                "tabs": self.pool.stats() if self.pool else None}
+
+
+# Spreads lookups over several browser instances, least loaded first, and keeps them healthy: a crashed instance is
+# restarted, one that served max_pages pages or grew past max_rss bytes is replaced by a fresh one, which takes new
+# lookups while the old one finishes the lookups it still holds.
+class BrowserSupervisor:
+
+    def __init__(self, launch, instances: int = 1, pool_size: int = 4, pool_timeout: float = 30, prepare=None,
+                 max_pages: int = 0, max_rss: int = 0, probe_timeout: float = 10, drain_timeout: float = 60):
+        self.instances = [BrowserInstance(i, launch, pool_size, pool_timeout, prepare) for i in range(instances)]
+        self.max_pages = max_pages
+        self.max_rss = max_rss
+        self.probe_timeout = probe_timeout
+        self.drain_timeout = drain_timeout
+        if max_rss and psutil is None:
+            logging.warning("psutil is not installed, browsers are not recycled on memory")
+        self._tasks = set()
+
+    @property
+    def running(self) -> list[BrowserInstance]:
+        return [instance for instance in self.instances if instance.running]
+
+    async def start(self):
+        results = await asyncio.gather(*(instance.start() for instance in self.instances if not instance.running),
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(f"Failed to start browser: {result!r}")
+        if not self.running:
+            raise results[0]
+
+    def tabs_stats(self) -> dict:
+        pools = [instance.pool.stats() for instance in self.running]
+        return {key: sum(pool[key] for pool in pools) for key in ("size", "in_use", "available", "waiting")}
+
+    def idle_capacity(self) -> int:
+        return sum(max(instance.pool.available - instance.pool.waiting, 0) for instance in self.running)
+
+    def stats(self, rss: bool = True) -> list[dict]:
+        return [instance.stats(rss) for instance in self.instances]
+
+    def rss(self) -> int:
+        return sum(instance.rss() for instance in self.instances)
+
+    @asynccontextmanager
+    async def tab(self, trace: metrics.Trace = None, timeout: float = None):
+        running = self.running
+        if not running:
+            raise PoolExhausted("No browser is running")
+        instance = min(running, key=lambda i: (i.pool.waiting - i.pool.available, i.pages))
+        pool = instance.pool
+        instance.pages += 1
+        try:
+            async with pool.tab(trace, timeout) as tab:
+                yield tab
+        finally:
+            if instance.pool is pool and instance.browser.stopped and not instance.restarting:
+                # claimed right away so the periodic check does not restart it a second time
+                instance.restarting = True
+                self._spawn(self._restart(instance, "crash"))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def check(self):
+        for instance in self.instances:
+            if instance.restarting:
+                continue
+            if not instance.running:
+                await self.restart(instance, "down")
+            elif not await instance.alive(self.probe_timeout):
+                await self.restart(instance, "crash")
+            elif self.max_pages and instance.pages >= self.max_pages:
+                await self.restart(instance, "pages")
+            elif self.max_rss and instance.rss() >= self.max_rss:
+                await self.restart(instance, "rss")
+
+    async def restart(self, instance: BrowserInstance, reason: str):
+        if instance.restarting:
+            return
+        instance.restarting = True
+        await self._restart(instance, reason)
+
+    async def _restart(self, instance: BrowserInstance, reason: str):
+        metrics.BROWSER_RESTARTS.inc(reason)
+        logging.warning(f"Restarting browser {instance.index} ({reason}) after {instance.pages} pages")
+        try:
+            if reason in ("crash", "down"):
+                await instance.stop()
+                await instance.start()
+            else:
+                old_browser, old_pool = instance.browser, instance.pool
+                await instance.start()
+                # lookups holding a tab of the old browser finish on it, it is stopped once they are done
+                deadline = time.monotonic() + self.drain_timeout
+                while old_pool.in_use and time.monotonic() < deadline:
+                    await asyncio.sleep(0.5)
+                await instance._stop_browser(old_browser)
+            instance.restarts += 1
+        except Exception as e:
+            logging.error(f"Failed to restart browser {instance.index}: {e!r}")
+        finally:
+            instance.restarting = False
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*(instance.stop() for instance in self.instances))
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key, fn, *args, ticket: Ticket = None):
+        # with a ticket, fn gets it as its last argument; a caller joining the flight raises the flight's ticket to
+        # its own priority, right away and whenever its own ticket is raised while it waits
+        flight = self._flights.get(key)
+        joined = None
+        if flight is None:
+            task = asyncio.ensure_future(fn(*args) if ticket is None else fn(*args, ticket))
+            flight = self._flights[key] = (task, ticket)
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+        else:
+            self.coalesced += 1
+            if ticket is not None and flight[1] is not None:
+                joined = flight[1]
+                joined.raise_to(ticket.priority)
+                ticket.watch(joined.raise_to)
+        try:
+            # shield so that a caller going away does not cancel the fetch for everyone else waiting on it
+            return await asyncio.shield(flight[0])
+        finally:
+            if joined is not None:
+                ticket.unwatch(joined.raise_to)
+
+    def promote(self, key, priority: str):
+        flight = self._flights.get(key)
+        if flight is not None and flight[1] is not None:
+            flight[1].raise_to(priority)
+
+
+# True once the DOM of the newly navigated document is parsed and contains the ready selector. The stale flag is set
+# on the previous document right before navigating, so a reused tab never captures the page of an earlier lookup.
+READY_SCRIPT = '!window.__wtStale && document.readyState !== "loading" && !!document.querySelector(%s)'
+
+REQUEST_TIMEOUT = {"code": 500, "message": "Request time out.", "tip": "Please try again later.", "data": None}
+INTERNAL_ERROR = {"code": 500, "message": "Internal Server Error", "tip": "Please try again later.", "data": None}
+SERVER_BUSY = {"code": 503, "message": "Server busy", "tip": "Please try again later.", "data": None}
+
+
 class Scraping(metaclass=Singleton):
 
-    def __init__(self, proxy_host: str = "", proxy_port: int = 0):
+    def __init__(self, proxy_host: str = "", proxy_port: int = 0, pool_size: int = 4, pool_timeout: float = 30,
+                 parser: str = None, parse_workers: int = 2, parse_queue: int = 32,
+                 block_resources: list[str] = None, block_urls: list[str] = None, allow_urls: list[str] = None,
+                 ready_selector: str = "#GCM-Container", poll_interval: float = 0.1, http_fast_path: bool = True,
+                 cookie_ttl: float = 900, sample_rate: float = 0, base_url: str = "https://warthunder.com",
+                 browsers: int = 1, max_pages: int = 0, max_rss: int = 0, upstream_rate: float = 5,
+                 upstream_burst: int = 10, wait_budgets: dict = None):
         self._inited = False
+        self._init_lock = asyncio.Lock()
         self.proxy_host = proxy_host
         self.proxy_port = proxy_port
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.parser = parser
+        self.parse_pool = parsing.ParsePool(workers=parse_workers, max_pending=parse_queue, parser=parser)
+        self.flights = SingleFlight()
+        self.blocker = RequestBlocker(block_resources, block_urls, allow_urls)
+        self.browsers = BrowserSupervisor(self._launch_browser, instances=browsers, pool_size=pool_size,
+                                          pool_timeout=pool_timeout, prepare=self.blocker.attach,
+                                          max_pages=max_pages, max_rss=max_rss)
+        self.ready_selector = ready_selector
+        self.poll_interval = poll_interval
+        self.http = HttpFetcher(USER_AGENT, proxy_host, proxy_port, cookie_ttl=cookie_ttl) if http_fast_path else None
+        self.sample_rate = sample_rate
+        self.upstream = UpstreamScheduler(upstream_rate, upstream_burst, wait_budgets)
+        self.base_url = base_url.rstrip("/")
+
+    async def async_init(self, trace: metrics.Trace = None):
+        async with self._init_lock:
+            if not self._inited:
+                with (trace or metrics.Trace("browser")).stage("browser_start"):
+                    await self.browsers.start()
+                self._inited = True
+
+    async def warm_up(self, nick: str = None) -> dict:
+        # what the first lookups would otherwise wait for: the browsers and their tabs, the parse workers and, given a
+        # player known to exist, the Cloudflare clearance of every browser and the cookies of the HTTP fast path
+        trace = metrics.Trace("warm_up")
+        await asyncio.gather(self.async_init(trace), self.parse_pool.warm_up())
+        report = {"browsers": len(self.browsers.running), "profiles": 0}
+        if nick:
+            url = f"{self.base_url}/en/community/userinfo/?nick={nick}"
+            results = await asyncio.gather(*(self._warm_up_instance(instance, url, trace)
+                                             for instance in self.browsers.running), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logging.warning(f"Failed to load {nick} while warming up: {result!r}")
+            report["profiles"] = sum(result is True for result in results)
+        return report
+
+    async def _warm_up_instance(self, instance: BrowserInstance, url: str, trace: metrics.Trace) -> bool:
+        await self.upstream.acquire("background")
+        async with instance.pool.tab(trace) as tab:
+            content = await self._load(tab, url, trace)
+        instance.pages += 1
+        if PROFILE_MARKER not in content:
+            return False
+        if self.http:
+            await self._harvest_cookies(instance.browser)
+        return True
+
+    async def _launch_browser(self):
+        args = [f"--user-agent={USER_AGENT}"]
+        if self.proxy_host:
+            args.append(f"--proxy-server=socks5://{self.proxy_host}:{self.proxy_port}")
+        return await zd.start(lang="en-US", browser_args=args, sandbox=True, headless=True)
+
+    async def supervise(self):
+        # started browsers are kept healthy from here on, before that the first lookup starts them
+        if self._inited:
+            await self.browsers.check()
+
+    def stats(self, rss: bool = True) -> dict:
+        # rss=False skips walking the browser processes, by far the most expensive number here
+        if self._inited:
+            tabs = self.browsers.tabs_stats()
+        else:
+            tabs = {"size": self.pool_size * len(self.browsers.instances), "in_use": 0, "available": 0, "waiting": 0}
+        return {"tabs": tabs, "browsers": self.browsers.stats(rss), "in_flight": self.flights.in_flight,
+                "coalesced": self.flights.coalesced, "parse": self.parse_pool.stats(),
+                "blocked_requests": self.blocker.blocked, "http": self.http.stats() if self.http else None,
+                "upstream": self.upstream.stats()}
+
+    def rss(self) -> int:
+        return self.browsers.rss()
+
+    async def fetch_stats(self) -> dict:
+        return self.stats()
+
+    def idle_capacity(self) -> int:
+        return self.browsers.idle_capacity()
+
+    async def close(self):
+        self.parse_pool.shutdown()
+        if self.http:
+            await self.http.close()
+        if self._inited:
+            await self.browsers.stop()
+            self._inited = False
+
+    async def get_player_stat(self, name: str, priority: str | Ticket = "interactive"):
+        # a more urgent lookup joining an in-flight scrape raises the priority the scrape waits with
+        ticket = priority if isinstance(priority, Ticket) else Ticket(priority)
+        return await self.flights.do(name, self._get_player_stat, name, ticket=ticket)
+
+    async def _load(self, tab, url: str, trace: metrics.Trace, timeout: float = 30) -> str:
+        with trace.stage("navigate"):
+            await tab.evaluate("window.__wtStale = true")
+            await tab.send(cdp.page.navigate(url))
+        script = READY_SCRIPT % json.dumps(self.ready_selector)
+        deadline = asyncio.get_running_loop().time() + timeout
+        with trace.stage("wait"):
+            while True:
+                try:
+                    ready = await tab.evaluate(script)
+                except ProtocolException:
+                    # the execution context is swapped out while the new document commits
+                    ready = False
+                if ready:
+                    break
+                if asyncio.get_running_loop().time() >= deadline:
+                    raise TimeoutError(f"{self.ready_selector} did not appear within {timeout}s")
+                await asyncio.sleep(self.poll_interval)
+        with trace.stage("content"):
+            content = await tab.evaluate("document.documentElement.outerHTML")
+            # everything the parser needs is captured, don't keep downloading the rest of the page
+            await tab.send(cdp.page.stop_loading())
+        return content
+
+    async def _harvest_cookies(self, browser):
+        try:
+            self.http.update_cookies(await browser.cookies.get_all())
+        except Exception as e:
+            logging.warning(f"Failed to harvest cookies: {e!r}")
+
+    def _busy(self, priority: str, retry_after: int = None) -> dict:
+        return dict(SERVER_BUSY, retry_after=retry_after or self.upstream.retry_after(priority))
 
-    async def async_init(self):
-        if not self._inited:
-            args = ["--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36"]
-            if self.proxy_host:
-                args.append(f"--proxy-server=socks5://{self.proxy_host}:{self.proxy_port}")
-            self.browser = await zd.start(lang="en-US", browser_args=args, sandbox=True, headless=True)
-            self._inited = True
+    async def _get_player_stat(self, name: str, ticket: Ticket):
+        trace = metrics.Trace(name, self.sample_rate)
+        outcome, result = await self._fetch_player_stat(name, trace, ticket)
+        trace.finish(outcome)
+        return result
 
-    async def get_player_stat(self, name: str):
+    async def _fetch_page(self, url: str, marker: str, trace: metrics.Trace,
+                          ticket: Ticket) -> tuple[str | None, str | dict]:
+        # the page with no outcome yet, or the outcome and response of a lookup that could not get it; the ticket's
+        # priority is read at every step, callers that joined meanwhile may have raised it
         try:
-            await self.async_init()
-            window = await self.browser.get(f"https://warthunder.com/en/community/userinfo/?nick={name}",
-                                            new_window=True)
+            with trace.stage("upstream_wait"):
+                await self.upstream.acquire(ticket)
+        except Overloaded as e:
+            return "shed", self._busy(ticket.priority, e.retry_after)
+        content = None
+        # whether the fast path is going to send a request of its own, the browser fallback then needs another token
+        sent = self.http is not None and self.http.enabled and not self.http.needs_cookies
+        if self.http:
+            challenges = self.http.challenges
+            with trace.stage("http_fetch"):
+                content = await self.http.fetch(url, marker)
+            if self.http.challenges > challenges:
+                self.upstream.report(ok=False)
+        if content is None:
+            if sent:
+                try:
+                    with trace.stage("upstream_wait"):
+                        await self.upstream.acquire(ticket)
+                except Overloaded as e:
+                    return "shed", self._busy(ticket.priority, e.retry_after)
+            await self.async_init(trace)
+            # failures leave the tab context so the pool replaces a tab that may be stuck mid-navigation; the token
+            # bucket does not see the tabs, so waiting for one is held to the same budget as waiting for a token
             try:
-                await window.wait_for(selector="#GCM-Container", timeout=30)
+                async with self.browsers.tab(trace, self.upstream.wait_budgets[ticket.priority]) as tab:
+                    content = await self._load(tab, url, trace)
+            except PoolExhausted:
+                return "busy", self._busy(ticket.priority)
             except TimeoutError:
-                await window.close()
-                return {"code": 500, "message": "Request time out.", "tip": "Please try again later.", "data": None}
-            except:
-                await window.close()
-                return {"code": 500, "message": "Internal Server Error", "tip": "Please try again later.", "data": None}
-            content = await window.get_content()
-            await window.close()
-            return self.analyze_html(content)
+                self.upstream.report(ok=False)
+                return "timeout", dict(REQUEST_TIMEOUT)
+            except Exception as e:
+                logging.error(f"Failed to load {url}: {e!r}")
+                return "500", dict(INTERNAL_ERROR)
+            if self.http and self.http.needs_cookies:
+                await self._harvest_cookies(tab.browser)
+        return None, content
+
+    async def _fetch_player_stat(self, name: str, trace: metrics.Trace, ticket: Ticket) -> tuple[str, dict | None]:
+        try:
+            url = f"{self.base_url}/en/community/userinfo/?nick={name}"
+            outcome, content = await self._fetch_page(url, PROFILE_MARKER, trace, ticket)
+            if outcome is not None:
+                return outcome, content
+            try:
+                result = await self.parse_pool.analyze_html(content, trace)
+            except parsing.ParseQueueFull:
+                return "busy", self._busy(ticket.priority)
+            self.upstream.report(ok=True)
+            if result["code"] == 200:
+                # kept next to the parsed result so sections can be parsed again later without another scrape
+                result["html"] = content
+            return str(result["code"]), result
         except Exception as e:
             logging.error(e)
             logging.error(traceback.format_exc())
+            return "500", None
 
-    @staticmethod
-    def analyze_html(html: str) -> dict:
-        data = {
-            "nickname": "",
-            "register_date": "",
-            "player_level": 0,
-            "clan_name": "",
-            "clan_url": "",
-            "avatar": "",
-            "statistics": {
-                "arcade": {
-                    "victories": 0,
-                    "completed_missions": 0,
-                    "victories_battles_ratio": "0%",
-                    "deaths": 0,
-                    "lions_earned": 0,
-                    "play_time": "0m",
-                    "air_targets_destroyed": 0,
-                    "ground_targets_destroyed": 0,
-                    "naval_targets_destroyed": 0,
-                    "aviation": {
-                        "air_battles": 0,
-                        "air_battles_fighters": 0,
-                        "air_battles_bombers": 0,
-                        "air_battles_attackers": 0,
-                        "time_played_air_battles": "0m",
-                        "time_played_fighter": "0m",
-                        "time_played_bomber": "0m",
-                        "time_played_attackers": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    },
-                    "ground": {
-                        "ground_battles": 0,
-                        "ground_battles_tanks": 0,
-                        "ground_battles_spgs": 0,
-                        "ground_battles_heavy_tanks": 0,
-                        "ground_battles_spaa": 0,
-                        "time_played_ground_battles": "0m",
-                        "tank_battle_time": "0m",
-                        "tank_destroyer_battle_time": "0m",
-                        "heavy_tank_battle_time": "0m",
-                        "spaa_battle_time": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    },
-                    "fleet": {
-                        "naval_battles": 0,
-                        "ship_battles": 0,
-                        "motor_torpedo_boat_battles": 0,
-                        "motor_gun_boat_battles": 0,
-                        "motor_torpedo_gun_boat_battles": 0,
-                        "sub_chaser_battles": 0,
-                        "destroyer_battles": 0,
-                        "naval_ferry_barge_battles": 0,
-                        "time_played_naval": "0m",
-                        "time_played_on_ship": "0m",
-                        "time_played_on_motor_torpedo_boat": "0m",
-                        "time_played_on_motor_gun_boat": "0m",
-                        "time_played_on_motor_torpedo_gun_boat": "0m",
-                        "time_played_on_sub_chaser": "0m",
-                        "time_played_on_destroyer": "0m",
-                        "time_played_on_naval_ferry_barge": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    }
-                },
-                "realistic": {
-                    "victories": 0,
-                    "completed_missions": 0,
-                    "victories_battles_ratio": "0%",
-                    "deaths": 0,
-                    "lions_earned": 0,
-                    "play_time": "0m",
-                    "air_targets_destroyed": 0,
-                    "ground_targets_destroyed": 0,
-                    "naval_targets_destroyed": 0,
-                    "aviation": {
-                        "air_battles": 0,
-                        "air_battles_fighters": 0,
-                        "air_battles_bombers": 0,
-                        "air_battles_attackers": 0,
-                        "time_played_air_battles": "0m",
-                        "time_played_fighter": "0m",
-                        "time_played_bomber": "0m",
-                        "time_played_attackers": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    },
-                    "ground": {
-                        "ground_battles": 0,
-                        "ground_battles_tanks": 0,
-                        "ground_battles_spgs": 0,
-                        "ground_battles_heavy_tanks": 0,
-                        "ground_battles_spaa": 0,
-                        "time_played_ground_battles": "0m",
-                        "tank_battle_time": "0m",
-                        "tank_destroyer_battle_time": "0m",
-                        "heavy_tank_battle_time": "0m",
-                        "spaa_battle_time": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    },
-                    "fleet": {
-                        "naval_battles": 0,
-                        "ship_battles": 0,
-                        "motor_torpedo_boat_battles": 0,
-                        "motor_gun_boat_battles": 0,
-                        "motor_torpedo_gun_boat_battles": 0,
-                        "sub_chaser_battles": 0,
-                        "destroyer_battles": 0,
-                        "naval_ferry_barge_battles": 0,
-                        "time_played_naval": "0m",
-                        "time_played_on_ship": "0m",
-                        "time_played_on_motor_torpedo_boat": "0m",
-                        "time_played_on_motor_gun_boat": "0m",
-                        "time_played_on_motor_torpedo_gun_boat": "0m",
-                        "time_played_on_sub_chaser": "0m",
-                        "time_played_on_destroyer": "0m",
-                        "time_played_on_naval_ferry_barge": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    }
-                },
-                "simulation": {
-                    "victories": 0,
-                    "completed_missions": 0,
-                    "victories_battles_ratio": "0%",
-                    "deaths": 0,
-                    "lions_earned": 0,
-                    "play_time": "0m",
-                    "air_targets_destroyed": 0,
-                    "ground_targets_destroyed": 0,
-                    "naval_targets_destroyed": 0,
-                    "aviation": {
-                        "air_battles": 0,
-                        "air_battles_fighters": 0,
-                        "air_battles_bombers": 0,
-                        "air_battles_attackers": 0,
-                        "time_played_air_battles": "0m",
-                        "time_played_fighter": "0m",
-                        "time_played_bomber": "0m",
-                        "time_played_attackers": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    },
-                    "ground": {
-                        "ground_battles": 0,
-                        "ground_battles_tanks": 0,
-                        "ground_battles_spgs": 0,
-                        "ground_battles_heavy_tanks": 0,
-                        "ground_battles_spaa": 0,
-                        "time_played_ground_battles": "0m",
-                        "tank_battle_time": "0m",
-                        "tank_destroyer_battle_time": "0m",
-                        "heavy_tank_battle_time": "0m",
-                        "spaa_battle_time": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    },
-                    "fleet": {
-                        "naval_battles": 0,
-                        "ship_battles": 0,
-                        "motor_torpedo_boat_battles": 0,
-                        "motor_gun_boat_battles": 0,
-                        "motor_torpedo_gun_boat_battles": 0,
-                        "sub_chaser_battles": 0,
-                        "destroyer_battles": 0,
-                        "naval_ferry_barge_battles": 1,
-                        "time_played_naval": "0m",
-                        "time_played_on_ship": "0m",
-                        "time_played_on_motor_torpedo_boat": "0m",
-                        "time_played_on_motor_gun_boat": "0m",
-                        "time_played_on_motor_torpedo_gun_boat": "0m",
-                        "time_played_on_sub_chaser": "0m",
-                        "time_played_on_destroyer": "0m",
-                        "time_played_on_naval_ferry_barge": "0m",
-                        "total_targets_destroyed": 0,
-                        "air_targets_destroyed": 0,
-                        "ground_targets_destroyed": 0,
-                        "naval_targets_destroyed": 0
-                    }
-                }
-            },
-            "vehicles_and_rewards": {
-                "USA": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "USSR": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "GreatBritain": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "Germany": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "Japan": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "Italy": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "France": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "China": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "Sweden": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                },
-                "Israel": {
-                    "owned_vehicles": 0,
-                    "elite_vehicles": 0,
-                    "medals": 0
-                }
-            }
-        }
-        try:
-            soup = BeautifulSoup(html, "html.parser")
-
-            output = {"code": 200,
-                      "message": "Success",
-                      "tip": "Fk cf!",
-                      "data": data}
-
-            # Get nickname while checking if the player exists
-            res = soup.select("li.user-profile__data-nick")
-            if len(res) == 0:
-                output["code"] = 404
-                output["message"] = "Player not found"
-                output["tip"] = "The nickname is case sensitive. Please check the nickname and try again."
-                return output
-
-            data["nickname"] = res[0].get_text(strip=True)
-
-            # Get player register date, player level, clan name and clan url
-            res = soup.select("div.user-profile > ul > li")
-            data["register_date"] = res[-1].get_text(strip=True)[18:]
-            data["player_level"] = int(res[-2].get_text(strip=True)[6:])
-            if len(res) == 5:  # has clan
-                data["clan_name"] = res[1].get_text(strip=True)
-                data["clan_url"] = f"https://warthunder.com{res[1].a.get('href', '')}"
-
-            # Get player avatar
-            res = soup.select("div.user-profile > div > img")
-            data["avatar"] = res[0].get("src", "")
-
-            # general statistics
-            modes = ["arcade", "realistic", "simulation"]
-            titles = ["victories", "completed_missions", "victories_battles_ratio", "deaths", "lions_earned",
-                      "play_time", "air_targets_destroyed", "ground_targets_destroyed", "naval_targets_destroyed"]
-
-            # general statistics: arcade
-            res = soup.select(
-                "div.community__user-rate.user-rate > div.user-profile__stat.user-stat > div > ul.user-stat__list.arcadeFightTab > li")
-            for i in range(1, len(res)):
-                stat = res[i].get_text(strip=True).replace(",", "")
-                if stat.isdigit():
-                    data["statistics"]["arcade"][titles[i - 1]] = int(stat)
-                elif stat != "N/A":
-                    data["statistics"]["arcade"][titles[i - 1]] = stat
-
-            # general statistics: realistic
-            res = soup.select(
-                "div.community__user-rate.user-rate > div.user-profile__stat.user-stat > div > ul.user-stat__list.historyFightTab > li")
-            for i in range(1, len(res)):
-                stat = res[i].get_text(strip=True).replace(",", "")
-                if stat.isdigit():
-                    data["statistics"]["realistic"][titles[i - 1]] = int(stat)
-                elif stat != "N/A":
-                    data["statistics"]["realistic"][titles[i - 1]] = stat
-
-            # general statistics: simulation
-            res = soup.select(
-                "div.community__user-rate.user-rate > div.user-profile__stat.user-stat > div > ul.user-stat__list.simulationFightTab > li")
-            for i in range(1, len(res)):
-                stat = res[i].get_text(strip=True).replace(",", "")
-                if stat.isdigit():
-                    data["statistics"]["simulation"][titles[i - 1]] = int(stat)
-                elif stat != "N/A":
-                    data["statistics"]["simulation"][titles[i - 1]] = stat
-
-            # specific statistics
-            three_modes = soup.select("div.user-rate__fightType > div > div.user-stat__list-row")
-
-            # specific statistics: aviation
-            titles = ["air_battles", "air_battles_fighters", "air_battles_bombers", "air_battles_attackers",
-                      "time_played_air_battles", "time_played_fighter", "time_played_bomber", "time_played_attackers",
-                      "total_targets_destroyed", "air_targets_destroyed", "ground_targets_destroyed",
-                      "naval_targets_destroyed"]
-
-            res = three_modes[0].select("ul.user-stat__list")[1:]
-            for i in range(len(res)):
-                stats = res[i].select("li")
-                for j in range(len(stats)):
-                    stat = stats[j].get_text(strip=True).replace(",", "")
-                    if stat.isdigit():
-                        data["statistics"][modes[i]]["aviation"][titles[j]] = int(stat)
-                    elif stat != "N/A":
-                        data["statistics"][modes[i]]["aviation"][titles[j]] = stat
-
-            # specific statistics: ground
-            titles = ["ground_battles", "ground_battles_tanks", "ground_battles_spgs", "ground_battles_heavy_tanks",
-                      "ground_battles_spaa", "time_played_ground_battles", "tank_battle_time",
-                      "tank_destroyer_battle_time", "heavy_tank_battle_time", "spaa_battle_time",
-                      "total_targets_destroyed", "air_targets_destroyed", "ground_targets_destroyed",
-                      "naval_targets_destroyed"]
-
-            res = three_modes[1].select("ul.user-stat__list")[1:]
-            for i in range(len(res)):
-                stats = res[i].select("li")
-                for j in range(len(stats)):
-                    stat = stats[j].get_text(strip=True).replace(",", "")
-                    if stat.isdigit():
-                        data["statistics"][modes[i]]["ground"][titles[j]] = int(stat)
-                    elif stat != "N/A":
-                        data["statistics"][modes[i]]["ground"][titles[j]] = stat
-
-            # specific statistics: fleet
-            titles = ["naval_battles", "ship_battles", "motor_torpedo_boat_battles", "motor_gun_boat_battles",
-                      "motor_torpedo_gun_boat_battles", "sub_chaser_battles", "destroyer_battles",
-                      "naval_ferry_barge_battles", "time_played_naval", "time_played_on_ship",
-                      "time_played_on_motor_torpedo_boat", "time_played_on_motor_gun_boat",
-                      "time_played_on_motor_torpedo_gun_boat", "time_played_on_sub_chaser", "time_played_on_destroyer",
-                      "time_played_on_naval_ferry_barge", "total_targets_destroyed", "air_targets_destroyed",
-                      "ground_targets_destroyed", "naval_targets_destroyed"]
-
-            res = three_modes[2].select("ul.user-stat__list")[1:]
-            for i in range(len(res)):
-                stats = res[i].select("li")
-                for j in range(len(stats)):
-                    stat = stats[j].get_text(strip=True).replace(",", "")
-                    if stat.isdigit():
-                        data["statistics"][modes[i]]["fleet"][titles[j]] = int(stat)
-                    elif stat != "N/A":
-                        data["statistics"][modes[i]]["fleet"][titles[j]] = stat
-
-            # vehicles and rewards
-            countries = ["USA", "USSR", "GreatBritain", "Germany", "Japan", "Italy", "France", "China", "Sweden",
-                         "Israel"]
-
-            # owned vehicles
-            res = soup.select("div.user-profile__score.user-score > ul:nth-child(2) > li")
-            for i in range(1, len(res)):
-                country = countries[i - 1]
-                data["vehicles_and_rewards"][country]["owned_vehicles"] = int(
-                    res[i].get_text(strip=True).replace(",", ""))
-
-            # elite vehicles
-            res = soup.select("div.user-profile__score.user-score > ul:nth-child(3) > li")
-            for i in range(1, len(res)):
-                country = countries[i - 1]
-                data["vehicles_and_rewards"][country]["elite_vehicles"] = int(
-                    res[i].get_text(strip=True).replace(",", ""))
-
-            # medals
-            res = soup.select("div.user-profile__score.user-score > ul:nth-child(4) > li")
-            for i in range(1, len(res)):
-                country = countries[i - 1]
-                data["vehicles_and_rewards"][country]["medals"] = int(res[i].get_text(strip=True).replace(",", ""))
-
-            output["data"] = data
-            return output
+    async def get_clan(self, name: str, priority: str | Ticket = "interactive"):
+        ticket = priority if isinstance(priority, Ticket) else Ticket(priority)
+        return await self.flights.do(("clan", name), self._get_clan, name, ticket=ticket)
+
+    async def _get_clan(self, name: str, ticket: Ticket):
+        trace = metrics.Trace(f"clan:{name}", self.sample_rate)
+        outcome, result = await self._fetch_clan(name, trace, ticket)
+        trace.finish(outcome)
+        return result
 
+    async def _fetch_clan(self, name: str, trace: metrics.Trace, ticket: Ticket) -> tuple[str, dict | None]:
+        try:
+            url = f"{self.base_url}/en/community/claninfo/{quote(name)}"
+            outcome, content = await self._fetch_page(url, SQUADRON_MARKER, trace, ticket)
+            if outcome is not None:
+                return outcome, content
+            try:
+                result = await self.parse_pool.analyze_clan_html(content, trace)
+            except parsing.ParseQueueFull:
+                return "busy", self._busy(ticket.priority)
+            self.upstream.report(ok=True)
+            return str(result["code"]), result
         except Exception as e:
             logging.error(e)
             logging.error(traceback.format_exc())
-            return {"code": 500, "message": "Internal Server Error", "tip": "Please try again later."}
+            return "500", None
+
+    async def analyze_snapshot(self, html: str, sections: tuple) -> dict:
+        try:
+            return await self.parse_pool.analyze_html(html, sections=sections)
+        except parsing.ParseQueueFull:
+            return self._busy("interactive")
+
+    @staticmethod
+    def analyze_html(html: str, parser: str = None) -> dict:
+        return parsing.analyze_html(html, parser)
@@ -0,0 +1,182 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+from fastapi_cache.types import Backend
+
+
+@dataclass
+class CacheEntry:
+    value: bytes
+    stored_at: float
+    stale_at: float
+    expires_at: float
+    # set for entries served over HTTP: the ETag of value and its precomputed compressed forms by content coding
+    etag: Optional[str] = None
+    encoded: dict = field(default_factory=dict)
+
+    @property
+    def stale(self) -> bool:
+        return time.time() >= self.stale_at
+
+
+# A fastapi-cache backend on a local SQLite file in WAL mode: every worker process on the node shares one cache and
+# entries survive restarts. Past its soft TTL (stale_at) an entry is still served while it is refreshed, past its
+# hard TTL (expires_at) it is gone.
+class SQLiteBackend(Backend):
+
+    def __init__(self, path: str = "cache.sqlite3", stale_ttl: int = 3600):
+        self.path = path
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            stored_at REAL NOT NULL,
+            stale_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            refresh_lease REAL NOT NULL DEFAULT 0
+        )""")
+        # columns added later, cache files written before them get them on start
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(cache)")}
+        for column in ("etag TEXT", "gzip BLOB", "br BLOB"):
+            if column.split()[0] not in columns:
+                try:
+                    self._conn.execute(f"ALTER TABLE cache ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    # another worker added it first
+                    pass
+        # case-folded nick -> spelling the profile page reported for it, with the cache entry it was learned with;
+        # the row goes once that entry is gone
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS nick_index (
+            folded TEXT PRIMARY KEY,
+            canonical TEXT NOT NULL
+        )""")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(nick_index)")}
+        for column in ("key TEXT", "seen_at REAL NOT NULL DEFAULT 0"):
+            if column.split()[0] not in columns:
+                try:
+                    self._conn.execute(f"ALTER TABLE nick_index ADD COLUMN {column}")
+                except sqlite3.OperationalError:
+                    # another worker added it first
+                    pass
+        # token buckets shared by the worker processes, e.g. the proactive refresh budget
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS token_buckets (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )""")
+        # counters and histograms of every worker process that has served /metrics, summed on render; rows of
+        # processes that have exited are kept so the totals never go back
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS worker_metrics (
+            worker TEXT PRIMARY KEY,
+            dump TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )""")
+
+    async def _run(self, sql: str, params: tuple = ()) -> tuple[list, int]:
+        def run():
+            with self._lock:
+                cursor = self._conn.execute(sql, params)
+                return cursor.fetchall(), cursor.rowcount
+
+        return await asyncio.to_thread(run)
+
+    async def get_entry(self, key: str) -> Optional[CacheEntry]:
+        rows, _ = await self._run("SELECT value, stored_at, stale_at, expires_at, etag, gzip, br FROM cache "
+                                  "WHERE key = ? AND expires_at > ?", (key, time.time()))
+        if not rows:
+            return None
+        value, stored_at, stale_at, expires_at, etag, gzip, br = rows[0]
+        encoded = {name: blob for name, blob in (("br", br), ("gzip", gzip)) if blob is not None}
+        return CacheEntry(value, stored_at, stale_at, expires_at, etag, encoded)
+
+    async def get_with_ttl(self, key: str) -> Tuple[int, Optional[bytes]]:
+        entry = await self.get_entry(key)
+        if entry is None:
+            return 0, None
+        return int(entry.expires_at - time.time()), entry.value
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = await self.get_entry(key)
+        return entry.value if entry else None
+
+    async def set(self, key: str, value: bytes, expire: Optional[int] = None, stale_ttl: Optional[int] = None,
+                  etag: Optional[str] = None, encoded: Optional[dict] = None,
+                  stored_at: Optional[float] = None) -> CacheEntry:
+        # stored_at defaults to now, values derived from an older entry keep the age of that entry
+        now = time.time()
+        stale_at = now + (expire or 0)
+        expires_at = stale_at + (self.stale_ttl if stale_ttl is None else stale_ttl)
+        stored_at = now if stored_at is None else stored_at
+        encoded = encoded or {}
+        await self._run("INSERT OR REPLACE INTO cache (key, value, stored_at, stale_at, expires_at, etag, gzip, br) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, value, stored_at, stale_at, expires_at, etag, encoded.get("gzip"), encoded.get("br")))
+        return CacheEntry(value, stored_at, stale_at, expires_at, etag, encoded)
+
+    async def acquire_refresh(self, key: str, lease: float) -> bool:
+        # only one worker process gets to refresh a stale entry until the lease runs out
+        now = time.time()
+        _, count = await self._run("UPDATE cache SET refresh_lease = ? WHERE key = ? AND refresh_lease < ?",
+                                   (now + lease, key, now))
+        return count == 1
+
+    async def take_token(self, bucket: str, rate: float, capacity: float) -> bool:
+        # one statement, so workers taking tokens at the same time cannot both spend the last one; a bucket starts
+        # full and refills at rate tokens per second
+        now = time.time()
+        _, count = await self._run(
+            "INSERT INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET tokens = MIN(tokens + (excluded.updated_at - updated_at) * ?, ?) - 1, "
+            "updated_at = excluded.updated_at WHERE MIN(tokens + (excluded.updated_at - updated_at) * ?, ?) >= 1",
+            (bucket, capacity - 1, now, rate, capacity, rate, capacity))
+        return count == 1
+
+    async def get_canonical(self, nick: str) -> Optional[str]:
+        rows, _ = await self._run("SELECT canonical FROM nick_index WHERE folded = ?", (nick.casefold(),))
+        return rows[0][0] if rows else None
+
+    async def set_canonical(self, nick: str, key: str):
+        await self._run("INSERT OR REPLACE INTO nick_index (folded, canonical, key, seen_at) VALUES (?, ?, ?, ?)",
+                        (nick.casefold(), nick, key, time.time()))
+
+    async def publish_metrics(self, worker: str, dump: str):
+        await self._run("INSERT OR REPLACE INTO worker_metrics (worker, dump, updated_at) VALUES (?, ?, ?)",
+                        (worker, dump, time.time()))
+
+    async def load_metrics(self) -> list[str]:
+        rows, _ = await self._run("SELECT dump FROM worker_metrics")
+        return [row[0] for row in rows]
+
+    async def prune(self, max_entries: Optional[int] = None) -> int:
+        _, count = await self._run("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        if max_entries:
+            # hot entries keep getting refreshed, so the least recently stored ones are the cold ones
+            _, evicted = await self._run("DELETE FROM cache WHERE key IN "
+                                         "(SELECT key FROM cache ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                                         (max_entries,))
+            count += evicted
+        # players whose cache entry expired or was evicted, rows from before the key column have none and go too
+        await self._run("DELETE FROM nick_index WHERE NOT EXISTS "
+                        "(SELECT 1 FROM cache WHERE cache.key = nick_index.key)")
+        return count
+
+    async def clear(self, namespace: Optional[str] = None, key: Optional[str] = None) -> int:
+        if namespace:
+            _, count = await self._run("DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(namespace), namespace))
+        elif key:
+            _, count = await self._run("DELETE FROM cache WHERE key = ?", (key,))
+        else:
+            return 0
+        return count
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
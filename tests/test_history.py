@@ -0,0 +1,90 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from history import FIELDS, HistoryStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.sqlite3"), keyframe_interval=3)
+    yield store
+    store.close()
+
+
+def vector(**changes) -> np.ndarray:
+    values = np.arange(len(FIELDS), dtype=np.float64)
+    for column, value in changes.items():
+        values[int(column[1:])] = value
+    return values
+
+
+def kinds(store: HistoryStore) -> list[int]:
+    return [row[0] for row in store._conn.execute("SELECT keyframe FROM history ORDER BY ts")]
+
+
+def load(store: HistoryStore, nick: str = "Alice", since: float = 0):
+    return asyncio.run(store.load(nick, since))
+
+
+def test_rebuilds_exact_states_across_keyframes(store):
+    recorded = [vector(c5=i, c7=i * 10) if i % 2 else vector(c5=i) for i in range(8)]
+    for ts, state in enumerate(recorded, start=1):
+        assert store._record("Alice", state, float(ts))
+    # a keyframe every keyframe_interval rows, only the changed columns in between
+    assert kinds(store) == [1, 0, 0, 1, 0, 0, 1, 0]
+    deltas = store._conn.execute("SELECT columns FROM history WHERE keyframe = 0").fetchall()
+    assert all(len(np.frombuffer(columns, dtype=np.uint16)) <= 2 for columns, in deltas)
+    times, states = load(store)
+    assert times.tolist() == [float(ts) for ts in range(1, 9)]
+    np.testing.assert_array_equal(states, np.array(recorded))
+
+
+def test_unchanged_poll_stores_nothing(store):
+    assert store._record("Alice", vector(), 1.0)
+    assert not store._record("Alice", vector(), 2.0)
+    assert store._record("Alice", vector(c3=-1), 3.0)
+    assert not store._record("Alice", vector(c3=-1), 4.0)
+    # also when the next row would be a keyframe
+    assert store._record("Alice", vector(c3=-2), 5.0)
+    assert not store._record("Alice", vector(c3=-2), 6.0)
+    assert kinds(store) == [1, 0, 0]
+
+
+def test_nan_columns_are_not_changes(store):
+    assert store._record("Alice", vector(c4=np.nan), 1.0)
+    assert not store._record("Alice", vector(c4=np.nan), 2.0)
+    assert store._record("Alice", vector(c4=np.nan, c9=0.5), 3.0)
+    columns, = store._conn.execute("SELECT columns FROM history WHERE ts = 3").fetchone()
+    assert np.frombuffer(columns, dtype=np.uint16).tolist() == [9]
+    _, states = load(store)
+    assert np.isnan(states[:, 4]).all()
+    assert states[-1, 9] == 0.5
+
+
+def test_load_since_starts_from_the_state_in_effect(store):
+    for ts in range(1, 8):
+        store._record("Alice", vector(c2=ts), float(ts))
+    times, states = load(store, since=5.5)
+    # the row of ts 5 is a delta on the keyframe of ts 4, its state applies at 5.5
+    assert times.tolist() == [5.0, 6.0, 7.0]
+    assert states[:, 2].tolist() == [5.0, 6.0, 7.0]
+    np.testing.assert_array_equal(states[0], vector(c2=5))
+    times, _ = load(store, since=0.5)
+    assert times.tolist() == [float(ts) for ts in range(1, 8)]
+
+
+def test_prune_keeps_the_last_keyframe_before_the_cutoff(store):
+    for ts in range(1, 9):
+        store._record("Alice", vector(c2=ts), float(ts))
+    store._record("Bob", vector(), 1.0)
+    # keyframes at 1, 4 and 7: rows 1 to 3 go, the keyframe at 4 stays for the deltas at 5 and 6
+    removed = asyncio.run(store.prune(5.5))
+    assert removed == 3
+    times, states = load(store)
+    assert times.tolist() == [4.0, 5.0, 6.0, 7.0, 8.0]
+    assert states[:, 2].tolist() == [4.0, 5.0, 6.0, 7.0, 8.0]
+    np.testing.assert_array_equal(load(store, since=5.5)[1][0], vector(c2=5))
+    # a player with a single keyframe keeps it
+    assert load(store, "Bob")[0].tolist() == [1.0]
@@ -0,0 +1,116 @@
+import time
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+import http_cache
+from http_cache import etag_matches, negotiate
+from storage import CacheEntry
+
+BOTH = {"br": b"", "gzip": b""}
+needs_brotli = pytest.mark.skipif(http_cache.brotli is None, reason="brotli is not installed")
+
+
+@needs_brotli
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", "br"),
+    ("gzip", "gzip"),
+    ("br;q=0, gzip", "gzip"),
+    ("br; q=0, gzip; q=0.5", "gzip"),
+    ("br;q=0,gzip;q=0", None),
+    ("*", "br"),
+    ("*;q=0", None),
+    ("br;q=0, *", "gzip"),
+    ("GZIP", "gzip"),
+    ("deflate, zstd", None),
+    ("identity", None),
+    ("", None),
+    ("br;q=oops, gzip", "gzip"),
+])
+def test_negotiate(header, expected):
+    assert negotiate(header, BOTH) == expected
+
+
+def test_negotiate_only_offers_what_was_precomputed():
+    assert negotiate("br, gzip", {"gzip": b""}) == "gzip"
+    # small bodies are not compressed at all
+    assert negotiate("br, gzip", {}) is None
+
+
+@pytest.mark.parametrize("header, expected", [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"abc-br"', True),
+    ('"abc-gzip"', True),
+    ('W/"abc-gzip"', True),
+    ('"x", "abc"', True),
+    ('"x",W/"abc-br"', True),
+    ("*", True),
+    (" * ", True),
+    ('"abcd"', False),
+    ('"ab"', False),
+    ('"x", "y"', False),
+    ("", False),
+    ('""', False),
+])
+def test_etag_matches(header, expected):
+    assert etag_matches(header, '"abc"') is expected
+
+
+def make_client(entry: CacheEntry) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/player")
+    async def player(request: Request):
+        return http_cache.respond(request, entry)
+
+    return TestClient(app)
+
+
+def test_response_headers_and_revalidation():
+    body = b'{"code": 200, "data": "' + b"x" * 2000 + b'"}'
+    etag, encoded = http_cache.prepare(body)
+    stored_at = time.time() - 100
+    client = make_client(CacheEntry(body, stored_at, stored_at + 300, stored_at + 3600, etag, encoded))
+
+    plain = client.get("/player", headers={"Accept-Encoding": "identity"})
+    assert plain.status_code == 200 and plain.content == body
+    assert plain.headers["etag"] == etag
+    assert plain.headers["cache-control"] == "public, max-age=300"
+    assert 100 <= int(plain.headers["age"]) <= 101
+    assert plain.headers["vary"] == "Accept-Encoding"
+    assert "content-encoding" not in plain.headers
+
+    zipped = client.get("/player", headers={"Accept-Encoding": "gzip"})
+    assert zipped.headers["content-encoding"] == "gzip"
+    assert zipped.headers["etag"] == etag[:-1] + '-gzip"'
+    assert zipped.content == body
+
+    # the tag of any coding revalidates, the 304 keeps the headers and drops the body
+    for tag in (etag, zipped.headers["etag"], "W/" + etag):
+        revalidated = client.get("/player", headers={"Accept-Encoding": "gzip", "If-None-Match": tag})
+        assert revalidated.status_code == 304
+        assert revalidated.content == b""
+        assert revalidated.headers["etag"] == zipped.headers["etag"]
+        assert revalidated.headers["cache-control"] == "public, max-age=300"
+        assert "age" in revalidated.headers
+    assert client.get("/player", headers={"If-None-Match": '"other"'}).status_code == 200
+
+
+@needs_brotli
+def test_brotli_tag():
+    body = b"y" * 2000
+    etag, encoded = http_cache.prepare(body)
+    now = time.time()
+    client = make_client(CacheEntry(body, now, now + 60, now + 120, etag, encoded))
+    response = client.get("/player", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["content-encoding"] == "br"
+    assert response.headers["etag"] == etag[:-1] + '-br"'
+
+
+def test_uncached_errors_are_not_stored():
+    now = time.time()
+    response = make_client(CacheEntry(b'{"code": 500}', now, now, now)).get("/player")
+    assert response.headers["cache-control"] == "no-store"
+    assert "etag" not in response.headers
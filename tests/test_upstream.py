@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+from upstream import Overloaded, Ticket, UpstreamScheduler
+
+
+async def settle():
+    # lets freshly created acquire() tasks reach the queue
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def drain(scheduler: UpstreamScheduler, tickets: list) -> list:
+    # the order in which the queued tickets get their token
+    order = []
+
+    async def acquire(name, ticket):
+        await scheduler.acquire(ticket)
+        order.append(name)
+
+    tasks = []
+    for name, ticket in tickets:
+        tasks.append(asyncio.create_task(acquire(name, ticket)))
+        await settle()
+    return tasks, order
+
+
+def test_sheds_past_the_wait_budget_with_retry_after():
+    async def run():
+        scheduler = UpstreamScheduler(rate=1, burst=1, wait_budgets={"interactive": 2})
+        await scheduler.acquire("interactive")
+        waiters = [asyncio.create_task(scheduler.acquire("interactive")) for _ in range(2)]
+        await settle()
+        assert scheduler.stats()["queued"]["interactive"] == 2
+        with pytest.raises(Overloaded) as error:
+            await scheduler.acquire("interactive")
+        assert error.value.retry_after == 3
+        assert scheduler.retry_after("interactive") == 3
+        assert scheduler.shed["interactive"] == 1
+        assert scheduler.admitted["interactive"] == 3
+        for waiter in waiters:
+            waiter.cancel()
+
+    asyncio.run(run())
+
+
+def test_background_budget_does_not_shed_interactive():
+    async def run():
+        scheduler = UpstreamScheduler(rate=1, burst=1, wait_budgets={"interactive": 5, "background": 0.5})
+        await scheduler.acquire("interactive")
+        with pytest.raises(Overloaded):
+            await scheduler.acquire("background")
+        waiter = asyncio.create_task(scheduler.acquire("interactive"))
+        await settle()
+        assert scheduler.stats()["queued"]["interactive"] == 1
+        waiter.cancel()
+
+    asyncio.run(run())
+
+
+def test_tokens_go_out_in_priority_order():
+    async def run():
+        scheduler = UpstreamScheduler(rate=50, burst=1, wait_budgets={"background": 60, "batch": 60})
+        await scheduler.acquire("interactive")
+        tasks, order = await drain(scheduler, [("background", "background"), ("batch", "batch"),
+                                               ("interactive", "interactive"), ("batch 2", "batch")])
+        await asyncio.gather(*tasks)
+        assert order == ["interactive", "batch", "batch 2", "background"]
+
+    asyncio.run(run())
+
+
+def test_raised_ticket_moves_ahead_of_lower_classes():
+    async def run():
+        scheduler = UpstreamScheduler(rate=50, burst=1, wait_budgets={"background": 60, "batch": 60})
+        await scheduler.acquire("interactive")
+        ticket = Ticket("background")
+        tasks, order = await drain(scheduler, [("batch", "batch"), ("interactive", "interactive"),
+                                               ("raised", ticket)])
+        ticket.raise_to("interactive")
+        # raised once, not counted twice
+        assert scheduler.stats()["queued"] == {"interactive": 2, "batch": 1, "background": 0}
+        # lowering is ignored
+        ticket.raise_to("background")
+        assert ticket.priority == "interactive"
+        await asyncio.gather(*tasks)
+        # behind the interactive job that was already waiting, ahead of the batch one
+        assert order == ["interactive", "raised", "batch"]
+        assert scheduler._queue == []
+
+    asyncio.run(run())
+
+
+def test_joining_a_flight_raises_its_ticket():
+    from scraping import SingleFlight
+
+    async def run():
+        scheduler = UpstreamScheduler(rate=50, burst=1, wait_budgets={"background": 60, "batch": 60})
+        await scheduler.acquire("interactive")
+        flights = SingleFlight()
+        order = []
+
+        async def lookup(name, ticket):
+            await scheduler.acquire(ticket)
+            order.append(name)
+            return name
+
+        first = asyncio.create_task(flights.do("refresh", lookup, "refresh", ticket=Ticket("background")))
+        await settle()
+        batch = asyncio.create_task(lookup("batch", "batch"))
+        await settle()
+        joined = asyncio.create_task(flights.do("refresh", lookup, "refresh", ticket=Ticket("interactive")))
+        assert await joined == "refresh" and await first == "refresh"
+        await batch
+        assert order == ["refresh", "batch"]
+        assert flights.coalesced == 1
+
+    asyncio.run(run())
+
+
+def test_aimd_backs_off_and_recovers():
+    scheduler = UpstreamScheduler(rate=10, min_factor=0.1, backoff=0.5, recovery=0.1)
+    scheduler.report(ok=False)
+    assert scheduler.current_rate == pytest.approx(5)
+    for _ in range(10):
+        scheduler.report(ok=False)
+    assert scheduler.factor == pytest.approx(0.1)
+    scheduler.report(ok=True)
+    assert scheduler.factor == pytest.approx(0.2)
+    for _ in range(20):
+        scheduler.report(ok=True)
+    assert scheduler.factor == 1.0
+
+
+def test_cancelled_waiter_is_skipped():
+    async def run():
+        scheduler = UpstreamScheduler(rate=50, burst=1)
+        await scheduler.acquire("interactive")
+        tasks, order = await drain(scheduler, [("gone", "interactive"), ("kept", "interactive")])
+        tasks[0].cancel()
+        await settle()
+        assert scheduler.stats()["queued"]["interactive"] == 1
+        await tasks[1]
+        assert order == ["kept"]
+        assert scheduler._queue == []
+        assert scheduler.stats()["queued"]["interactive"] == 0
+
+    asyncio.run(run())
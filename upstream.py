@@ -0,0 +1,153 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+
+import metrics
+
+# served in this order, a waiting interactive lookup always goes before batch and background work
+PRIORITIES = ("interactive", "batch", "background")
+
+
+class Overloaded(Exception):
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Upstream queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+# The priority one lookup waits for its upstream slot with. A more urgent caller coalesced onto the lookup raises
+# it, and whoever holds the ticket at that moment (the scheduler queue, a nested lookup) follows through watch().
+class Ticket:
+
+    def __init__(self, priority: str = "interactive"):
+        self.priority = priority
+        self._watchers = []
+
+    def watch(self, callback):
+        self._watchers.append(callback)
+
+    def unwatch(self, callback):
+        if callback in self._watchers:
+            self._watchers.remove(callback)
+
+    def raise_to(self, priority: str):
+        if PRIORITIES.index(priority) >= PRIORITIES.index(self.priority):
+            return
+        self.priority = priority
+        for callback in list(self._watchers):
+            callback(priority)
+
+
+# Admission control for requests to warthunder.com. A global token bucket of rate requests per second (burst deep)
+# is handed out in priority order. A job whose expected queue wait exceeds the budget of its priority class is
+# rejected right away with a Retry-After hint instead of waiting for a tab until it times out. Timeouts and challenge
+# pages halve the rate, every success wins back a little of it (AIMD).
+class UpstreamScheduler:
+
+    def __init__(self, rate: float = 5, burst: int = 10, wait_budgets: dict = None, min_factor: float = 0.1,
+                 backoff: float = 0.5, recovery: float = 0.02):
+        self.rate = rate
+        # at least one token, a bucket that can never hold one would never admit anything
+        self.burst = max(burst, 1)
+        self.wait_budgets = {"interactive": 5, "batch": 30, "background": 10, **(wait_budgets or {})}
+        self.min_factor = min_factor
+        self.backoff = backoff
+        self.recovery = recovery
+        self.factor = 1.0
+        self.admitted = dict.fromkeys(PRIORITIES, 0)
+        self.shed = dict.fromkeys(PRIORITIES, 0)
+        self._tokens = float(self.burst)
+        self._tokens_at = time.monotonic()
+        self._queue = []
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    @property
+    def current_rate(self) -> float:
+        return self.rate * self.factor
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._tokens_at) * self.current_rate, self.burst)
+        self._tokens_at = now
+
+    def _waiting(self, rank: int) -> int:
+        return sum(1 for r, _, future in self._queue if r <= rank and future is not None and not future.done())
+
+    def expected_wait(self, priority: str = "interactive") -> float:
+        self._refill()
+        deficit = self._waiting(PRIORITIES.index(priority)) + 1 - self._tokens
+        return max(deficit, 0) / self.current_rate
+
+    def retry_after(self, priority: str = "interactive") -> int:
+        return max(math.ceil(self.expected_wait(priority)), 1)
+
+    async def acquire(self, ticket: Ticket | str = "interactive"):
+        if isinstance(ticket, str):
+            ticket = Ticket(ticket)
+        priority = ticket.priority
+        rank = PRIORITIES.index(priority)
+        wait = self.expected_wait(priority)
+        if wait > self.wait_budgets[priority]:
+            self.shed[priority] += 1
+            metrics.UPSTREAM_SHED.inc(priority)
+            raise Overloaded(max(math.ceil(wait), 1))
+        self.admitted[priority] += 1
+        if not self._queue and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = [rank, next(self._seq), future]
+        heapq.heappush(self._queue, entry)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        def promote(to: str):
+            # queued again under the new rank but with the same sequence number, so it keeps its place among the
+            # jobs of that class that were already waiting; the old entry is emptied for the dispatcher to drop
+            nonlocal entry
+            if future.done():
+                return
+            entry[2] = None
+            entry = [PRIORITIES.index(to), entry[1], future]
+            heapq.heappush(self._queue, entry)
+
+        ticket.watch(promote)
+        try:
+            # a caller that goes away leaves a cancelled future behind, the dispatcher skips it
+            await future
+        finally:
+            ticket.unwatch(promote)
+
+    async def _dispatch(self):
+        while self._queue:
+            future = self._queue[0][2]
+            if future is None or future.done():
+                heapq.heappop(self._queue)
+                continue
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                heapq.heappop(self._queue)[2].set_result(None)
+                continue
+            await asyncio.sleep((1 - self._tokens) / self.current_rate)
+
+    def report(self, ok: bool):
+        # tokens earned so far are counted at the old rate
+        self._refill()
+        if ok:
+            self.factor = min(self.factor + self.recovery, 1.0)
+        elif self.factor > self.min_factor:
+            self.factor = max(self.factor * self.backoff, self.min_factor)
+            logging.warning(f"Upstream is pushing back, slowing down to {self.current_rate:.2f} requests/s")
+
+    def stats(self) -> dict:
+        queued = dict.fromkeys(PRIORITIES, 0)
+        for rank, _, future in self._queue:
+            if future is not None and not future.done():
+                queued[PRIORITIES[rank]] += 1
+        return {"rate": round(self.current_rate, 3), "factor": round(self.factor, 3), "queued": queued,
+                "admitted": self.admitted, "shed": self.shed}